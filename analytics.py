@@ -0,0 +1,132 @@
+"""
+リードタイム分析モジュール
+スクレイピング結果から日付列をまとめてパースし、ステータス別件数・工程ごとのリードタイム分位点・
+遅延注文をpandas/NumPyで計算する（シート側の数式を使わずにサマリーシートを作成するため）
+"""
+import os
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from data_processor import DataProcessor, settled_statuses
+
+logger = logging.getLogger(__name__)
+
+# 工程順の日付列（フィールド名, 表示名）
+DATE_COLUMNS = [
+    ("orderedAt", "注文日"),
+    ("estimatedAt", "見積完了日"),
+    ("purchasedAt", "買付完了日"),
+    ("arrivedChinaAt", "中国事務所到着日"),
+    ("shippableAt", "発送可能日"),
+]
+
+# リードタイムの分位点
+PERCENTILES = [50, 90, 95]
+
+# 注文日からこの日数を過ぎても発送可能になっていない注文を遅延とみなす
+DEFAULT_OVERDUE_DAYS = 30
+
+
+def build_order_frame(results):
+    """
+    スクレイピング結果を注文単位のDataFrameに変換（日付列はdatetimeに変換）
+
+    Args:
+        results: スクレイピング結果（1商品1レコード）
+
+    Returns:
+        pd.DataFrame: 注文番号で重複を除いたDataFrame
+    """
+    records = DataProcessor.prepare_records(results)
+    df = pd.DataFrame(records)
+    if df.empty:
+        return df
+
+    # 日付・ステータスは注文単位で同じため、商品ごとの行をまとめる
+    df = df[df["orderId"] != ""].drop_duplicates("orderId").reset_index(drop=True)
+    for field, _ in DATE_COLUMNS:
+        # 日付の書式は注文ごとに異なり得るため、値ごとに書式を判定する（列単位の推定では他の書式が欠損になる）
+        df[field] = pd.to_datetime(df[field].str.strip(), errors="coerce", format="mixed")
+    return df
+
+
+def _format_days(value):
+    """日数を表示用に整形（欠損は空欄）"""
+    return "" if pd.isna(value) else round(float(value), 1)
+
+
+def compute_summary(results, overdue_days=None, now=None):
+    """
+    リードタイムのサマリーを計算
+
+    Args:
+        results: スクレイピング結果
+        overdue_days: 遅延とみなす経過日数（Noneの場合は環境変数 YIWU_OVERDUE_DAYS）
+        now: 基準日時（テスト・再計算用、デフォルトは現在時刻）
+
+    Returns:
+        List[List]: サマリーシートに書き込む2次元配列
+    """
+    if overdue_days is None:
+        overdue_days = int(os.environ.get("YIWU_OVERDUE_DAYS", DEFAULT_OVERDUE_DAYS))
+    now = now or datetime.now()
+
+    df = build_order_frame(results)
+    values = [
+        ["集計日時", now.strftime("%Y-%m-%d %H:%M:%S")],
+        ["注文数", len(df)],
+        [],
+    ]
+    if df.empty:
+        return values
+
+    # ステータス別件数
+    values.append(["ステータス", "件数"])
+    for status, count in df["status"].value_counts().items():
+        values.append([status or "（空欄）", int(count)])
+    values.append([])
+
+    # 工程ごとのリードタイム（日）
+    values.append(["工程", "件数", "平均（日）"] + [f"p{p}（日）" for p in PERCENTILES] + ["最大（日）"])
+    stages = list(zip(DATE_COLUMNS, DATE_COLUMNS[1:])) + [(DATE_COLUMNS[0], DATE_COLUMNS[-1])]
+    for (start_field, start_label), (end_field, end_label) in stages:
+        days = ((df[end_field] - df[start_field]).dt.total_seconds() / 86400).dropna()
+        if days.empty:
+            values.append([f"{start_label} → {end_label}", 0] + [""] * (len(PERCENTILES) + 2))
+            continue
+        quantiles = np.percentile(days.to_numpy(), PERCENTILES)
+        values.append(
+            [f"{start_label} → {end_label}", int(days.size), _format_days(days.mean())]
+            + [_format_days(q) for q in quantiles]
+            + [_format_days(days.max())]
+        )
+    values.append([])
+
+    # 遅延注文（注文日から overdue_days 日を過ぎても発送可能日が空欄。キャンセル等の完了済みの注文は除く）
+    dates = df[[field for field, _ in DATE_COLUMNS]]
+    reached = dates.notna().to_numpy()
+    # 最後に日付が入っている工程（日付が1つもない場合は-1）
+    last_stage = np.where(reached.any(axis=1), reached.shape[1] - 1 - np.argmax(reached[:, ::-1], axis=1), -1)
+    elapsed = (pd.Timestamp(now) - df["orderedAt"]).dt.total_seconds() / 86400
+    in_flight = ~df["status"].str.strip().isin(settled_statuses())
+    overdue_mask = (df["shippableAt"].isna() & (elapsed > overdue_days) & in_flight).to_numpy()
+
+    overdue = df[overdue_mask].assign(elapsed=elapsed[overdue_mask], last_stage=last_stage[overdue_mask])
+    overdue = overdue.sort_values("elapsed", ascending=False)
+
+    values.append([f"遅延注文（注文日から{overdue_days}日超で未発送、完了済みを除く）", len(overdue)])
+    values.append(["注文番号", "ステータス", "注文日", "経過日数", "現在の工程", "注文詳細リンク"])
+    for row in overdue.itertuples(index=False):
+        stage_label = DATE_COLUMNS[row.last_stage][1] if row.last_stage >= 0 else ""
+        values.append([
+            row.orderId,
+            row.status,
+            row.orderedAt.strftime("%Y-%m-%d"),
+            _format_days(row.elapsed),
+            stage_label,
+            row.detailLink,
+        ])
+
+    logger.info(f"リードタイム集計完了: 注文{len(df)}件、遅延{len(overdue)}件")
+    return values
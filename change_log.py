@@ -0,0 +1,191 @@
+"""
+変更履歴（CDC）モジュール
+同期のたびに注文の状態遷移（ステータス変更・日付の記入・新規商品など）を1項目1イベントとして
+ローカルのSQLiteに追記する。時刻・注文番号・イベント種別にインデックスを張り、
+「時刻T以降の変更」や通知ルールをシート全体の走査・差分計算なしに処理できるようにする
+"""
+import os
+import uuid
+import logging
+import sqlite3
+from datetime import datetime
+from env_config import data_path
+
+logger = logging.getLogger(__name__)
+
+# イベント種別
+EVENT_NEW_ITEM = "new_item"  # 新規商品の追加
+EVENT_STATUS_CHANGE = "status_change"  # ステータスの変更
+EVENT_DATE_FILLED = "date_filled"  # 日付が空欄から記入された
+EVENT_FIELD_CHANGE = "field_change"  # その他の項目の変更
+EVENT_ARCHIVED = "archived"  # アーカイブへの移動
+
+# 日付項目（空欄から記入された場合は date_filled として記録）
+DATE_FIELDS = {"orderedAt", "estimatedAt", "purchasedAt", "arrivedChinaAt", "shippableAt"}
+
+EVENT_COLUMNS = ["id", "ts", "run_id", "order_id", "item_name", "color_size", "event_type", "field",
+                 "old_value", "new_value"]
+
+
+def classify_change(field, old_value, new_value):
+    """項目の変更をイベント種別に分類"""
+    if field == "status":
+        return EVENT_STATUS_CHANGE
+    if field in DATE_FIELDS and not old_value.strip() and new_value.strip():
+        return EVENT_DATE_FILLED
+    return EVENT_FIELD_CHANGE
+
+
+def make_event(key, event_type, field="", old_value="", new_value=""):
+    """
+    イベントを作成
+
+    Args:
+        key: 複合キー（注文番号, 商品名, 色サイズ）
+        event_type: イベント種別
+        field: 変更された項目
+        old_value: 変更前の値
+        new_value: 変更後の値
+
+    Returns:
+        Dict: イベント
+    """
+    order_id, item_name, color_size = key
+    return {
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "order_id": order_id,
+        "item_name": item_name,
+        "color_size": color_size,
+        "event_type": event_type,
+        "field": field,
+        "old_value": str(old_value),
+        "new_value": str(new_value),
+    }
+
+
+def _on_ephemeral_filesystem(path):
+    """
+    Cloud Run上で、パスがボリュームマウント外（実行ごとに破棄されるコンテナのファイルシステム）にあるかどうか
+
+    Args:
+        path: ファイルパス
+
+    Returns:
+        bool: Cloud Run上でマウント外の場合True（ローカル実行ではFalse）
+    """
+    if not (os.environ.get("CLOUD_RUN_JOB") or os.environ.get("K_SERVICE")):
+        return False
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory != os.path.dirname(directory):
+        if os.path.ismount(directory):
+            return False
+        directory = os.path.dirname(directory)
+    return True
+
+
+class ChangeLog:
+    """追記専用の変更履歴クラス"""
+
+    def __init__(self, path=None):
+        """
+        初期化
+
+        Args:
+            path: SQLiteファイルのパス（Noneの場合は data/changes.db）
+        """
+        self.path = path or data_path("changes.db")
+        self.run_id = uuid.uuid4().hex[:12]  # 同じ同期で発生したイベントをまとめるID
+
+        if _on_ephemeral_filesystem(self.path):
+            logger.warning(f"変更履歴 {self.path} はボリュームマウント外にあり、実行終了時に破棄されます。"
+                           "実行をまたいだ変更の取得には、YIWU_CHANGE_LOG にCloud Storage等のマウント先を指定してください")
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS events ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, ts TEXT NOT NULL, run_id TEXT NOT NULL, "
+                    "order_id TEXT NOT NULL, item_name TEXT NOT NULL, color_size TEXT NOT NULL, "
+                    "event_type TEXT NOT NULL, field TEXT NOT NULL, old_value TEXT NOT NULL, new_value TEXT NOT NULL)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_events_order ON events (order_id, ts)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_events_type ON events (event_type, ts)")
+        finally:
+            conn.close()
+
+    @classmethod
+    def from_env(cls):
+        """
+        環境変数 YIWU_CHANGE_LOG から生成
+
+        Returns:
+            ChangeLog（空文字が設定されている場合は無効としてNone）
+        """
+        path = os.environ.get("YIWU_CHANGE_LOG", data_path("changes.db"))
+        if not path:
+            logger.info("YIWU_CHANGE_LOGが空のため、変更履歴は記録しません")
+            return None
+        return cls(path)
+
+    def _connect(self):
+        # 呼び出しごとに接続する（書き込みスレッドが変わっても安全にするため）
+        return sqlite3.connect(self.path)
+
+    def record(self, events):
+        """
+        イベントを追記
+
+        Args:
+            events: イベントのリスト
+        """
+        if not events:
+            return
+        columns = EVENT_COLUMNS[1:]
+        sql = f"INSERT INTO events ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+        rows = [[self.run_id if c == "run_id" else e[c] for c in columns] for e in events]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(sql, rows)
+        finally:
+            conn.close()
+
+    def since(self, ts=None, after_id=None, event_type=None, order_id=None):
+        """
+        条件に合うイベントを古い順に取得（インデックスを使うため件数は変更数に比例）
+
+        Args:
+            ts: この時刻（ISO形式）以降のイベント
+            after_id: このイベントIDより後のイベント（コンシューマーが処理済み位置を保持する場合）
+            event_type: イベント種別で絞り込み
+            order_id: 注文番号で絞り込み
+
+        Yields:
+            Dict: イベント
+        """
+        conditions, params = [], []
+        if ts:
+            conditions.append("ts >= ?")
+            params.append(ts)
+        if after_id is not None:
+            conditions.append("id > ?")
+            params.append(after_id)
+        if event_type:
+            conditions.append("event_type = ?")
+            params.append(event_type)
+        if order_id:
+            conditions.append("order_id = ?")
+            params.append(order_id)
+
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        conn = self._connect()
+        try:
+            for row in conn.execute(f"SELECT {', '.join(EVENT_COLUMNS)} FROM events{where} ORDER BY id", params):
+                yield dict(zip(EVENT_COLUMNS, row))
+        finally:
+            conn.close()
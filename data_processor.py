@@ -0,0 +1,122 @@
+"""
+データ処理モジュール
+スクレイピング結果を出力先（Google Sheets・ローカルファイル等）向けの形式に変換する
+"""
+import os
+
+# 完了とみなすステータス（環境変数 YIWU_ARCHIVE_STATUSES で上書き可能）
+DEFAULT_SETTLED_STATUSES = "発送済み,発送済,キャンセル"
+
+# レコードのフィールド（出力列の順序）
+RECORD_FIELDS = [
+    "status",
+    "orderId",
+    "orderedAt",
+    "estimatedAt",
+    "purchasedAt",
+    "arrivedChinaAt",
+    "shippableAt",
+    "detailLink",
+    "orderLink",
+    "imageUrl",
+    "itemName",
+    "colorSize",
+]
+
+
+def settled_statuses():
+    """完了とみなすステータスの集合を取得"""
+    return {
+        s.strip() for s in os.environ.get("YIWU_ARCHIVE_STATUSES", DEFAULT_SETTLED_STATUSES).split(",") if s.strip()
+    }
+
+
+class DataProcessor:
+    """データ処理クラス"""
+    
+    @staticmethod
+    def prepare_google_sheets_data(results):
+        """Google Sheets用のデータを準備"""
+        from datetime import datetime
+        
+        headers = [
+            "ステータス",
+            "注文番号",
+            "注文日",
+            "見積完了日",
+            "買付完了日",
+            "中国事務所到着日",
+            "発送可能日",
+            "注文詳細リンク",
+            "商品リンク",
+            "商品画像",
+            "商品名",
+            "色・サイズ等指定",
+            "更新日",
+        ]
+        
+        # 現在の日時を取得
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
+        values = [headers]
+        for r in results:
+            values.append([
+                r.get("status", ""),
+                r.get("orderId", ""),
+                r.get("orderedAt", ""),
+                r.get("estimatedAt", ""),
+                r.get("purchasedAt", ""),
+                r.get("arrivedChinaAt", ""),
+                r.get("shippableAt", ""),
+                r.get("detailLink", ""),
+                r.get("orderLink", ""),
+                r.get("imageUrl", ""),
+                r.get("itemName", ""),
+                r.get("colorSize", ""),  # 色・サイズ等指定
+                current_time,  # 更新日
+            ])
+        return values
+    
+    @staticmethod
+    def prepare_records(results):
+        """
+        ローカル出力用のデータを準備（フィールドを揃え、更新日時を付与）
+        
+        Returns:
+            List[Dict]: RECORD_FIELDS と updatedAt を持つレコードのリスト
+        """
+        from datetime import datetime
+        
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
+        records = []
+        for r in results:
+            record = {field: r.get(field, "") or "" for field in RECORD_FIELDS}
+            record["updatedAt"] = current_time
+            records.append(record)
+        return records
+    
+    @staticmethod
+    def prioritize(results):
+        """
+        書き込み・取得の優先順に並べ替え
+        進行中の注文を完了済みの注文より先にし、それぞれ一覧の表示順（新しい順）を保つ
+        
+        Returns:
+            List[Dict]: 並べ替えたレコードのリスト（元のリストは変更しない）
+        """
+        settled = settled_statuses()
+        return sorted(results, key=lambda r: (r.get("status", "").strip() in settled))
+    
+    @staticmethod
+    def split_deferred(results):
+        """
+        詳細ページの取得を見送ったレコードを分離
+        （色・サイズ等指定が未取得のまま書き込むと複合キーが変わるため、次回の実行に回す）
+        
+        Returns:
+            Tuple[List[Dict], List[Dict]]: (書き込み対象, 見送ったレコード)
+        """
+        ready = [r for r in results if not r.get("deferred")]
+        deferred = [r for r in results if r.get("deferred")]
+        return ready, deferred
@@ -0,0 +1,27 @@
+"""
+環境変数の読み込みヘルパー
+"""
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def env_float(name, default):
+    """環境変数から数値を取得（未設定・不正値の場合はデフォルト値）"""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"環境変数 {name} の値が不正です（{value}）。デフォルト値 {default} を使用します")
+        return default
+
+
+def data_path(filename):
+    """
+    ローカルに保存するファイル（ステージ間の受け渡し・SQLite・スナップショット・変更履歴）のパスを取得
+    配置先は環境変数 YIWU_DATA_DIR（デフォルト: data）。.env の読み込み後に反映されるよう、呼び出し時に読み込む
+    """
+    return os.path.join(os.environ.get("YIWU_DATA_DIR", "data"), filename)
@@ -0,0 +1,254 @@
+"""
+詳細ページ取得のリトライポリシーモジュール
+リンク単位の締め切り、ジッター付きバックオフ、ヘッジリクエスト、サーキットブレーカーを提供
+"""
+import os
+import random
+import asyncio
+import logging
+from collections import deque
+from env_config import env_float
+
+logger = logging.getLogger(__name__)
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_LINK_DEADLINE = 120  # 1リンクあたりの全体締め切り（秒）
+DEFAULT_ATTEMPT_TIMEOUT = 45  # 1回の試行のタイムアウト（秒）
+DEFAULT_MAX_RETRIES = 3  # 最大試行回数
+DEFAULT_BASE_BACKOFF = 1.0  # 初期待機時間（秒）
+DEFAULT_MAX_BACKOFF = 15.0  # 最大待機時間（秒）
+
+# ヘッジ設定
+HEDGE_PERCENTILE = 95  # この分位点のレイテンシを超えたら重複リクエストを開始
+HEDGE_MIN_SAMPLES = 10  # ヘッジ判定に必要な最小サンプル数
+HEDGE_MAX_RATIO = 0.1  # ヘッジリクエストの上限（全リクエストに対する割合）
+LATENCY_WINDOW = 200  # レイテンシを保持する直近のサンプル数
+
+# サーキットブレーカー設定
+BREAKER_WINDOW = 20  # 失敗率を計算する直近の試行数
+BREAKER_MIN_CALLS = 10  # 判定に必要な最小試行数
+BREAKER_FAILURE_RATIO = 0.5  # この失敗率以上でブレーカーを開く
+BREAKER_COOLDOWN = 30  # ブレーカーを開いてから再開するまでの時間（秒）
+
+
+class LatencyTracker:
+    """直近の取得レイテンシを保持し、分位点を計算するクラス"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds):
+        """成功した取得のレイテンシを記録"""
+        self.samples.append(seconds)
+
+    def percentile(self, p, min_samples=HEDGE_MIN_SAMPLES):
+        """
+        分位点を計算
+
+        Args:
+            p: 分位点（0〜100）
+            min_samples: 計算に必要な最小サンプル数
+
+        Returns:
+            分位点のレイテンシ（秒）。サンプル不足の場合はNone
+        """
+        if len(self.samples) < min_samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """サイト全体が失敗している間、すべての取得を一時停止するサーキットブレーカー"""
+
+    def __init__(self, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_ratio=BREAKER_FAILURE_RATIO, cooldown=BREAKER_COOLDOWN):
+        self.outcomes = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.open_until = 0.0
+
+    def record_success(self):
+        """成功を記録"""
+        self.outcomes.append(True)
+
+    def record_failure(self):
+        """失敗を記録し、失敗率がしきい値を超えたらブレーカーを開く"""
+        self.outcomes.append(False)
+        if len(self.outcomes) < self.min_calls:
+            return
+
+        failures = self.outcomes.count(False)
+        if failures / len(self.outcomes) >= self.failure_ratio:
+            loop = asyncio.get_running_loop()
+            if self.open_until <= loop.time():
+                logger.error(
+                    f"詳細ページの取得失敗が続いています（直近{len(self.outcomes)}件中{failures}件）。"
+                    f"{self.cooldown}秒間すべての取得を停止します"
+                )
+            self.open_until = loop.time() + self.cooldown
+            self.outcomes.clear()
+
+    async def wait_until_closed(self, deadline):
+        """
+        ブレーカーが開いている間待機
+
+        Args:
+            deadline: 待機を打ち切る時刻（イベントループ時刻）
+
+        Raises:
+            asyncio.TimeoutError: 締め切りまでにブレーカーが閉じなかった場合
+        """
+        loop = asyncio.get_running_loop()
+        while self.open_until > loop.time():
+            if self.open_until >= deadline:
+                raise asyncio.TimeoutError("サーキットブレーカーが開いたまま締め切りに達しました")
+            await asyncio.sleep(self.open_until - loop.time())
+
+
+class FetchPolicy:
+    """詳細ページ取得のリトライポリシー"""
+
+    def __init__(self, link_deadline=DEFAULT_LINK_DEADLINE, attempt_timeout=DEFAULT_ATTEMPT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, base_backoff=DEFAULT_BASE_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, hedge=True):
+        """
+        初期化
+
+        Args:
+            link_deadline: 1リンクあたりの全体締め切り（秒）。リトライ・待機を含む
+            attempt_timeout: 1回の試行のタイムアウト（秒）
+            max_retries: 最大試行回数
+            base_backoff: 初期待機時間（秒）
+            max_backoff: 最大待機時間（秒）
+            hedge: p95レイテンシを超えた取得に重複リクエストを出すかどうか
+        """
+        self.link_deadline = link_deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max(1, int(max_retries))
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+        self.request_count = 0
+        self.hedge_count = 0
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から設定を読み込んで生成"""
+        hedge_str = os.environ.get("YIWU_DETAIL_HEDGE", "true").lower()
+        return cls(
+            link_deadline=env_float("YIWU_DETAIL_DEADLINE", DEFAULT_LINK_DEADLINE),
+            attempt_timeout=env_float("YIWU_DETAIL_ATTEMPT_TIMEOUT", DEFAULT_ATTEMPT_TIMEOUT),
+            max_retries=env_float("YIWU_DETAIL_MAX_RETRIES", DEFAULT_MAX_RETRIES),
+            hedge=hedge_str in ("true", "1", "yes"),
+        )
+
+    def _backoff(self, attempt):
+        """ジッター付きの待機時間を計算（Full Jitter）"""
+        cap = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    async def execute(self, fetch, label):
+        """
+        ポリシーに従って取得を実行
+
+        Args:
+            fetch: 取得処理（引数なしでコルーチンを返す関数）。キャンセル時にリソースを解放すること
+            label: ログ出力用のラベル（URLなど）
+
+        Returns:
+            取得結果
+
+        Raises:
+            Exception: 締め切りまでに成功しなかった場合は最後のエラー
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.link_deadline
+        last_error = None
+
+        for attempt in range(self.max_retries):
+            await self.breaker.wait_until_closed(deadline)
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+
+            try:
+                result = await asyncio.wait_for(self._hedged(fetch, label),
+                                                timeout=min(self.attempt_timeout, remaining))
+                self.breaker.record_success()
+                return result
+            except Exception as e:
+                self.breaker.record_failure()
+                last_error = e
+
+            if attempt < self.max_retries - 1:
+                wait_time = self._backoff(attempt)
+                if loop.time() + wait_time >= deadline:
+                    break
+                logger.warning(f"詳細ページ {label} の読み込みに失敗。{wait_time:.1f}秒後にリトライします"
+                               f"（{attempt + 1}/{self.max_retries}）: {last_error!r}")
+                await asyncio.sleep(wait_time)
+
+        if last_error is None:
+            last_error = asyncio.TimeoutError(f"締め切り（{self.link_deadline}秒）に達しました")
+        raise last_error
+
+    async def _timed(self, fetch):
+        """取得を実行し、成功時のレイテンシを記録"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        result = await fetch()
+        self.latency.record(loop.time() - started)
+        return result
+
+    def _hedge_delay(self):
+        """ヘッジリクエストを開始するまでの待機時間（ヘッジしない場合はNone）"""
+        if not self.hedge:
+            return None
+        if self.hedge_count >= max(1, self.request_count * HEDGE_MAX_RATIO):
+            return None
+        return self.latency.percentile(HEDGE_PERCENTILE)
+
+    async def _hedged(self, fetch, label):
+        """
+        取得を実行し、p95レイテンシを超えたら重複リクエストを開始して先に成功した結果を返す
+        """
+        self.request_count += 1
+        primary = asyncio.ensure_future(self._timed(fetch))
+        tasks = {primary}
+
+        try:
+            hedge_delay = self._hedge_delay()
+            if hedge_delay is None:
+                return await primary
+
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if done:
+                return primary.result()
+
+            self.hedge_count += 1
+            logger.info(f"詳細ページ {label} の取得が{hedge_delay:.1f}秒（p{HEDGE_PERCENTILE}）を超えたため、"
+                        f"重複リクエストを開始します")
+            tasks.add(asyncio.ensure_future(self._timed(fetch)))
+
+            last_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            # キャンセルしたタスクのページクローズを待つ
+            await asyncio.gather(*tasks, return_exceptions=True)
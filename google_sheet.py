@@ -2,13 +2,19 @@
 import os
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import gspread
+from dateutil import parser as date_parser
 from gspread.exceptions import APIError
 from google.oauth2.service_account import Credentials
 from google.auth import default
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from slack_notifier import SlackNotifier
+from data_processor import settled_statuses, RECORD_FIELDS
+from change_log import ChangeLog, make_event, classify_change, EVENT_NEW_ITEM, EVENT_DATE_FILLED, EVENT_ARCHIVED
+import profiling
 
 # ログ設定
 logger = logging.getLogger(__name__)
@@ -20,11 +26,19 @@ SCOPES = [
 ]
 
 # 列のインデックス定数
+COL_STATUS = 0  # A列（ステータス）
 COL_ORDER_ID = 1  # B列（注文番号）
+COL_ORDER_DATE = 2  # C列（注文日）
 COL_ARRIVAL_DATE = 5  # F列（中国事務所到着日）
+COL_SHIPPABLE_DATE = 6  # G列（発送可能日）
 COL_IMAGE = 9  # J列（商品画像）- 更新チェックの最終列
 COL_ITEM_NAME = 10  # K列（商品名）
 COL_COLOR_SIZE = 11  # L列（色・サイズ等指定）
+COL_UPDATED_AT = 12  # M列（更新日）
+
+# アーカイブ判定の基準日の列（先頭から順に、空欄・不正値でない最初の値を使う）
+# キャンセル等は発送可能日が入らないため、最後に変更された更新日、それもなければ注文日を使う
+ARCHIVE_AGE_COLUMNS = (COL_SHIPPABLE_DATE, COL_UPDATED_AT, COL_ORDER_DATE)
 
 # デフォルト値
 DEFAULT_NUM_COLS = 26  # デフォルトは26列（A-Z）
@@ -34,9 +48,20 @@ MAX_RETRIES = 5  # 最大リトライ回数
 INITIAL_BACKOFF = 2  # 初期待機時間（秒）
 MAX_BACKOFF = 120  # 最大待機時間（秒）
 
+# アーカイブ設定（完了済みの注文をアーカイブ用ワークシートに移動）
+# 完了とみなすステータスは YIWU_ARCHIVE_STATUSES（data_processor.settled_statuses）
+DEFAULT_ARCHIVE_DAYS = 30  # 発送可能日からこの日数を過ぎた注文を移動（0で無効）
+
 # バッチサイズ
 BATCH_SIZE = 3  # 一度に処理する行数（APIクォータ制限に対応）
 BATCH_WAIT_TIME = 30  # バッチ間の待機時間（秒）
+SMALL_WRITE_MAX_ROWS = 20  # この行数以下の書き込みはクォータ（毎分60リクエスト）に収まるため待機しない
+DEFAULT_API_CALL_SECONDS = 1.0  # API呼び出しの所要時間（実測値がない場合の見積もり）
+
+
+def row_write_seconds(api_seconds=DEFAULT_API_CALL_SECONDS):
+    """1行の書き込みにかかる時間（API呼び出し + クォータ回避の待機の按分）"""
+    return api_seconds + BATCH_WAIT_TIME / BATCH_SIZE
 
 
 class GSheet:
@@ -74,25 +99,51 @@ class GSheet:
             logger.info("Workload Identity（Application Default Credentials）で認証します")
             creds, _ = default(scopes=SCOPES)
         
-        # gspreadクライアントの初期化
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(self.spreadsheet_id)
-        self.ws = sh.worksheet(self.worksheet_name)
-        
-        # Google Sheets API v4サービスの初期化（テーブル操作用）
-        self.service = build('sheets', 'v4', credentials=creds)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Google Sheets API v4サービスの初期化（テーブル操作用）
+            # ディスカバリー文書の読み込みはgspreadの初期化と並行して行う
+            service_future = executor.submit(build, 'sheets', 'v4', credentials=creds)
+            
+            # gspreadクライアントの初期化
+            gc = gspread.authorize(creds)
+            self.sh = gc.open_by_key(self.spreadsheet_id)
+            self.ws = self.sh.worksheet(self.worksheet_name)
+            
+            self.service = service_future.result()
         self.sheet_id = self.ws.id
         
         # Slack通知の初期化
         self.slack_notifier = SlackNotifier()
+        
+        # 変更履歴（状態遷移のイベントログ）の初期化
+        self.change_log = ChangeLog.from_env()
+        
+        # アーカイブ設定
+        self.archive_worksheet_name = os.environ.get("GOOGLE_SHEETS_ARCHIVE_WORKSHEET", "yiwu_archive")
+        self.archive_days = int(os.environ.get("YIWU_ARCHIVE_DAYS", DEFAULT_ARCHIVE_DAYS))
+        self.archive_statuses = settled_statuses()
+        self._archive_ws = None
+        
+        # prefetch() で事前取得した既存データ（次回のwriteで使用）
+        self._prefetched = None
+        
+        # API呼び出しの実測値（書き込み時間の見積もりに使用）
+        self._api_calls = 0
+        self._api_seconds = 0.0
+        
+        # テーブルIDと列数のキャッシュ（常駐時に毎回シートを読み込まないため）
+        self._table_id = None
+        self._num_cols = None
     
     def get_table_id(self):
         """
-        ワークシート内の最初のテーブルのIDを取得
+        ワークシート内の最初のテーブルのIDを取得（取得できた場合はキャッシュ）
         
         Returns:
             テーブルID（存在しない場合はNone）
         """
+        if self._table_id is not None:
+            return self._table_id
         try:
             spreadsheet = self.service.spreadsheets().get(
                 spreadsheetId=self.spreadsheet_id,
@@ -104,10 +155,12 @@ class GSheet:
                     # dataSourceTableオブジェクトを探す
                     for data_source in sheet.get('dataSource', []):
                         if 'dataSourceTableId' in data_source:
-                            return data_source['dataSourceTableId']
+                            self._table_id = data_source['dataSourceTableId']
+                            return self._table_id
                     # 通常のテーブルを探す
                     for table in sheet.get('tables', []):
-                        return table.get('tableId')
+                        self._table_id = table.get('tableId')
+                        return self._table_id
             return None
         except Exception as e:
             logger.error(f"テーブルID取得エラー: {e}")
@@ -115,15 +168,18 @@ class GSheet:
     
     def _get_num_cols(self):
         """
-        現在のシートの列数を取得
+        現在のシートの列数を取得（ヘッダー行の列数、書き込み時に読み込んだヘッダーがあればそれを使う）
         
         Returns:
             列数（取得できない場合はデフォルト値）
         """
+        if self._num_cols:
+            return self._num_cols
         try:
-            all_values = self.ws.get_all_values()
-            if all_values:
-                return len(all_values[0])
+            header = self.ws.row_values(1)
+            if header:
+                self._num_cols = len(header)
+                return self._num_cols
         except Exception as e:
             logger.warning(f"列数取得エラー: {e}")
         return DEFAULT_NUM_COLS
@@ -174,6 +230,7 @@ class GSheet:
             logger.error(f"テーブル範囲拡張エラー: {e}")
             logger.info("代替として、Google Sheetsでテーブル範囲を手動で調整してください。")
     
+    @profiling.timed
     def _execute_with_retry(self, func, *args, **kwargs):
         """
         指数バックオフでAPIリクエストをリトライ
@@ -192,8 +249,12 @@ class GSheet:
         backoff = INITIAL_BACKOFF
         
         for attempt in range(MAX_RETRIES):
+            started = time.monotonic()
             try:
-                return func(*args, **kwargs)
+                result = func(*args, **kwargs)
+                self._api_calls += 1
+                self._api_seconds += time.monotonic() - started
+                return result
             except (HttpError, APIError) as e:
                 # HttpErrorの場合
                 is_quota_error = False
@@ -217,6 +278,263 @@ class GSheet:
                 logger.error(f"予期しないエラー: {e}")
                 raise
     
+    def write_summary(self, values, worksheet_name):
+        """
+        サマリーを別ワークシートに書き込み（既存の内容は置き換え）
+        クリアと書き込みを1回のbatchUpdateで行う
+        
+        Args:
+            values: 書き込むデータ（2次元配列）
+            worksheet_name: 書き込み先のワークシート名（存在しない場合は作成）
+        """
+        num_rows = max(len(values), 1)
+        num_cols = max((len(row) for row in values), default=1)
+        
+        try:
+            summary_ws = self._execute_with_retry(self.sh.worksheet, worksheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            logger.info(f"ワークシート {worksheet_name} を作成します")
+            summary_ws = self._execute_with_retry(
+                self.sh.add_worksheet, title=worksheet_name, rows=num_rows, cols=num_cols
+            )
+        
+        rows = []
+        for row in values:
+            cells = []
+            for value in row:
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    cells.append({'userEnteredValue': {'stringValue': str(value)}})
+                else:
+                    cells.append({'userEnteredValue': {'numberValue': value}})
+            rows.append({'values': cells})
+        
+        # 行数・列数が足りない場合は拡張し、既存セルをすべてクリアしてから書き込む
+        requests = [
+            {
+                'updateSheetProperties': {
+                    'properties': {
+                        'sheetId': summary_ws.id,
+                        'gridProperties': {
+                            'rowCount': max(num_rows, summary_ws.row_count),
+                            'columnCount': max(num_cols, summary_ws.col_count),
+                        }
+                    },
+                    'fields': 'gridProperties(rowCount,columnCount)'
+                }
+            },
+            {
+                'updateCells': {
+                    'range': {'sheetId': summary_ws.id},
+                    'fields': 'userEnteredValue'
+                }
+            },
+            {
+                'updateCells': {
+                    'start': {'sheetId': summary_ws.id, 'rowIndex': 0, 'columnIndex': 0},
+                    'rows': rows,
+                    'fields': 'userEnteredValue'
+                }
+            },
+        ]
+        
+        # メインシートの書き込みと並行して同じクライアントから呼ばれるため、スレッドセーフでない
+        # googleapiclient（httplib2）ではなくgspreadのセッションで送信する
+        self._execute_with_retry(self.sh.batch_update, {'requests': requests})
+        logger.info(f"サマリーをワークシート {worksheet_name} に書き込みました（{len(values)}行）")
+    
+    @staticmethod
+    def _row_key(row):
+        """行から複合キー（注文番号+商品名+色サイズ）を作成"""
+        return (
+            row[COL_ORDER_ID] if len(row) > COL_ORDER_ID else "",
+            row[COL_ITEM_NAME] if len(row) > COL_ITEM_NAME else "",
+            row[COL_COLOR_SIZE] if len(row) > COL_COLOR_SIZE else ""
+        )
+    
+    def _get_archive_worksheet(self, header=None):
+        """
+        アーカイブ用ワークシートを取得
+        
+        Args:
+            header: 存在しない場合に作成して書き込むヘッダー行（Noneの場合は作成しない）
+            
+        Returns:
+            ワークシート（存在せず作成もしない場合はNone）
+        """
+        if self._archive_ws is not None:
+            return self._archive_ws
+        
+        try:
+            self._archive_ws = self._execute_with_retry(self.sh.worksheet, self.archive_worksheet_name)
+        except gspread.exceptions.WorksheetNotFound:
+            if header is None:
+                return None
+            logger.info(f"アーカイブ用ワークシート {self.archive_worksheet_name} を作成します")
+            self._archive_ws = self._execute_with_retry(
+                self.sh.add_worksheet, title=self.archive_worksheet_name, rows=1, cols=max(len(header), 1)
+            )
+            self._execute_with_retry(self._archive_ws.update, "A1", [header])
+        return self._archive_ws
+    
+    def _load_archived_keys(self):
+        """
+        アーカイブ済みの複合キーを取得（キー列のみを1回のリクエストで読み込む）
+        
+        Returns:
+            Set[Tuple]: アーカイブ済みの複合キー
+        """
+        archive_ws = self._get_archive_worksheet()
+        if archive_ws is None:
+            return set()
+        
+        # 表示形式（日付・数値の書式）に左右されないよう、書式適用前の値を読み込む
+        return set(self._read_keys(archive_ws, value_render_option="UNFORMATTED_VALUE"))
+    
+    def _read_keys(self, ws, value_render_option=None):
+        """
+        ワークシートのキー列（注文番号・商品名・色サイズ）のみを1回のリクエストで読み込む
+        
+        Args:
+            ws: ワークシート
+            value_render_option: 値の取得形式（Noneの場合は表示形式）
+            
+        Returns:
+            List[Tuple]: ヘッダー行を除く各行の複合キー（末尾の空行は含まない）
+        """
+        columns = [chr(65 + col) for col in (COL_ORDER_ID, COL_ITEM_NAME, COL_COLOR_SIZE)]
+        order_ids, item_names, color_sizes = self._execute_with_retry(
+            ws.batch_get, [f"{c}2:{c}" for c in columns], value_render_option=value_render_option
+        )
+        
+        def column(values):
+            return [str(row[0]) if row else "" for row in values]
+        
+        order_ids, item_names, color_sizes = column(order_ids), column(item_names), column(color_sizes)
+        row_count = max(len(order_ids), len(item_names), len(color_sizes))
+        keys = [
+            (
+                order_ids[i] if i < len(order_ids) else "",
+                item_names[i] if i < len(item_names) else "",
+                color_sizes[i] if i < len(color_sizes) else ""
+            )
+            for i in range(row_count)
+        ]
+        return self._trim_empty_keys(keys)
+    
+    @staticmethod
+    def _trim_empty_keys(keys):
+        """末尾のキーが空の行を除く"""
+        while keys and not any(keys[-1]):
+            keys.pop()
+        return keys
+    
+    def _is_snapshot_current(self, all_existing_data):
+        """
+        事前取得したデータが現在のシートと一致するか確認（キー列のみを読み込んで行の並びを比較）
+        行番号による更新・削除の前に確認し、並べ替えや他の書き込みで行がずれていないことを保証する
+        
+        Args:
+            all_existing_data: 事前取得した全既存データ（ヘッダー行を含む）
+            
+        Returns:
+            bool: 一致する場合True
+        """
+        snapshot_keys = self._trim_empty_keys([self._row_key(row) for row in all_existing_data[1:]])
+        return self._read_keys(self.ws) == snapshot_keys
+    
+    def _is_settled(self, row, cutoff):
+        """行が完了済みで、基準日（発送可能日 → 更新日 → 注文日の順）がcutoffより前かどうか"""
+        status = row[COL_STATUS].strip() if len(row) > COL_STATUS else ""
+        if status not in self.archive_statuses:
+            return False
+        
+        for col in ARCHIVE_AGE_COLUMNS:
+            value = row[col].strip() if len(row) > col else ""
+            if not value:
+                continue
+            try:
+                return date_parser.parse(value) < cutoff
+            except (ValueError, OverflowError):
+                continue
+        return False
+    
+    def archive_settled_orders(self, all_existing_data, archived_keys):
+        """
+        完了済みの注文をアーカイブ用ワークシートに移動
+        追記（1回）→ 削除（1回のbatchUpdate）の順で行うため、途中で失敗してもデータは失われない
+        
+        Args:
+            all_existing_data: メインシートの全既存データ（ヘッダー行を含む）
+            archived_keys: アーカイブ済みの複合キー（移動した行のキーを追加する）
+            
+        Returns:
+            移動後のメインシートの全データ
+        """
+        if self.archive_days <= 0 or len(all_existing_data) <= 1:
+            return all_existing_data
+        
+        cutoff = datetime.now() - timedelta(days=self.archive_days)
+        settled_indices = [
+            idx for idx in range(1, len(all_existing_data))
+            if self._is_settled(all_existing_data[idx], cutoff)
+        ]
+        if not settled_indices:
+            return all_existing_data
+        
+        logger.info(f"完了済みの注文{len(settled_indices)}行をワークシート {self.archive_worksheet_name} に移動します")
+        
+        # アーカイブに追記（前回削除に失敗して残っている行は重複して追記しない）
+        archive_ws = self._get_archive_worksheet(header=all_existing_data[0])
+        rows_to_append = []
+        for idx in settled_indices:
+            key = self._row_key(all_existing_data[idx])
+            if key not in archived_keys:
+                rows_to_append.append(all_existing_data[idx])
+                archived_keys.add(key)
+        if rows_to_append:
+            # メインシートと同じくRAWで書き込む（USER_ENTEREDでは色サイズ「1/2」が日付に、
+            # 0埋めの注文番号が数値に変換され、アーカイブ済みキーと一致しなくなる）
+            self._execute_with_retry(archive_ws.append_rows, rows_to_append, value_input_option="RAW")
+        
+        # メインシートから削除（連続する行をまとめ、下の行から削除してインデックスのずれを防ぐ）
+        ranges = []
+        for idx in settled_indices:
+            if ranges and ranges[-1][1] == idx:
+                ranges[-1][1] = idx + 1
+            else:
+                ranges.append([idx, idx + 1])
+        requests = [
+            {
+                'deleteDimension': {
+                    'range': {
+                        'sheetId': self.sheet_id,
+                        'dimension': 'ROWS',
+                        'startIndex': start,
+                        'endIndex': end
+                    }
+                }
+            }
+            for start, end in reversed(ranges)
+        ]
+        self._execute_with_retry(
+            self.service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id,
+                body={'requests': requests}
+            ).execute
+        )
+        
+        # アーカイブへの移動を変更履歴に記録
+        self._record_changes([
+            make_event(self._row_key(all_existing_data[idx]), EVENT_ARCHIVED,
+                       new_value=self.archive_worksheet_name)
+            for idx in settled_indices
+        ])
+        
+        settled = set(settled_indices)
+        remaining = [row for idx, row in enumerate(all_existing_data) if idx not in settled]
+        logger.info(f"アーカイブ完了: {len(settled_indices)}行を移動（メインシート残り{len(remaining) - 1}行）")
+        return remaining
+    
     def _should_update_row(self, row_index, row_data, all_existing_data):
         """
         行を更新すべきかチェック（現在の値と新しい値を比較）
@@ -252,7 +570,50 @@ class GSheet:
             logger.warning(f"行比較エラー（更新を実行します）: {e}")
             return True
     
-    def _update_existing_order(self, row_index, row_data, order_id, new_arrival_date, old_arrival_date):
+    def _diff_row(self, key, existing_row, row_data):
+        """
+        既存の行と新しい行を項目ごとに比較し、変更イベントを作成
+        
+        Args:
+            key: 複合キー（注文番号, 商品名, 色サイズ）
+            existing_row: 既存の行
+            row_data: 新しい行
+            
+        Returns:
+            List[Dict]: 変更された項目ごとのイベント
+        """
+        events = []
+        for i, field in enumerate(RECORD_FIELDS):
+            old_value = str(existing_row[i]).strip() if i < len(existing_row) else ""
+            new_value = str(row_data[i]).strip() if i < len(row_data) else ""
+            if old_value != new_value:
+                events.append(make_event(key, classify_change(field, old_value, new_value), field, old_value, new_value))
+        return events
+    
+    def _record_changes(self, events):
+        """
+        変更イベントを変更履歴に追記し、通知ルールを適用
+        
+        Args:
+            events: 変更イベントのリスト
+        """
+        if not events:
+            return
+        
+        if self.change_log is not None:
+            try:
+                self.change_log.record(events)
+            except Exception as e:
+                logger.error(f"変更履歴の記録エラー: {e}")
+        
+        # F列（到着日）が空から値ありに変更された場合のみ、Slack通知を送信
+        # （新規追加時は通知しない。初回追加時に到着日がある場合は既存データのインポートの可能性が高い）
+        for event in events:
+            if event["event_type"] == EVENT_DATE_FILLED and event["field"] == "arrivedChinaAt":
+                logger.info(f"  → 中国事務所到着日が更新されました。Slack通知を送信します。")
+                self.slack_notifier.send_arrival_notification(event["order_id"], event["new_value"])
+    
+    def _update_existing_order(self, row_index, row_data, order_id):
         """
         既存の注文を更新
         
@@ -260,8 +621,6 @@ class GSheet:
             row_index: 行インデックス（1から始まる）
             row_data: 更新するデータ
             order_id: 注文番号
-            new_arrival_date: 新しい到着日
-            old_arrival_date: 既存の到着日
         """
         end_col = len(row_data)
         range_name = f"A{row_index}:{chr(64 + end_col)}{row_index}"
@@ -278,14 +637,6 @@ class GSheet:
         logger.info(f"  中国事務所到着日: {row_data[5] if len(row_data) > 5 else ''}")
         logger.info(f"  発送可能日: {row_data[6] if len(row_data) > 6 else ''}")
         logger.info(f"  商品名: {row_data[10] if len(row_data) > 10 else ''}")
-        
-        # F列（到着日）が空から値ありに変更された場合のみ、Slack通知を送信
-        old_arrival_empty = not old_arrival_date or not old_arrival_date.strip()
-        new_arrival_exists = new_arrival_date and new_arrival_date.strip()
-        
-        if old_arrival_empty and new_arrival_exists:
-            logger.info(f"  → 中国事務所到着日が更新されました。Slack通知を送信します。")
-            self.slack_notifier.send_arrival_notification(order_id, new_arrival_date)
     
     def _add_new_order(self, row_data, order_id, new_arrival_date):
         """
@@ -308,17 +659,98 @@ class GSheet:
         logger.info(f"  中国事務所到着日: {row_data[5] if len(row_data) > 5 else ''}")
         logger.info(f"  発送可能日: {row_data[6] if len(row_data) > 6 else ''}")
         logger.info(f"  商品名: {row_data[10] if len(row_data) > 10 else ''}")
+    
+    def prefetch(self):
+        """
+        既存データとアーカイブ済みキーを事前に取得（スクレイピング中に読み込みを済ませるため）
+        取得したデータは次回のwriteで1度だけ使用される（キー列の並びが変わっていた場合は再取得される）
+        """
+        logger.info("既存データを事前取得中...")
+        all_existing_data = self._execute_with_retry(self.ws.get_all_values)
+        archived_keys = self._load_archived_keys() if self.archive_days > 0 else set()
+        self._prefetched = (all_existing_data, archived_keys)
+        logger.info(f"既存データの事前取得完了: {len(all_existing_data)}行")
+    
+    def estimate_write_seconds(self, values):
+        """
+        書き込みにかかる時間を見積もり
+        事前取得したデータと比較して追加・更新が必要な行数を数え、1行あたりの所要時間
+        （API呼び出しの実測平均 + クォータ回避の待機 BATCH_WAIT_TIME / BATCH_SIZE）を掛ける
         
-        # 新規追加時は通知しない（初回追加時に到着日がある場合は既存データのインポートの可能性が高い）
+        Args:
+            values: 書き込むデータ（ヘッダー行を含む）。詳細ページ取得前でもよい（色サイズは比較しない）
+            
+        Returns:
+            float: 見積もり時間（秒）
+        """
+        data_rows = values[1:]
+        prefetched = self._prefetched
+        if prefetched is None:
+            # 既存データがない場合はすべての行を書き込むものとして見積もる
+            pending = len(data_rows)
+        else:
+            all_existing_data, archived_keys = prefetched
+            archived_orders = {key[0] for key in archived_keys}
+            
+            def order_fields(row):
+                # 注文単位の列（ステータス〜発送可能日）
+                return [str(v).strip() for v in row[:COL_SHIPPABLE_DATE + 1]]
+            
+            existing = {}  # {(注文番号, 商品名): 注文単位の列}
+            for row in all_existing_data[1:]:
+                key = self._row_key(row)[:2]
+                existing.setdefault(key, order_fields(row))
+            pending = sum(
+                1 for row in data_rows
+                if row[COL_ORDER_ID] not in archived_orders
+                and existing.get(self._row_key(row)[:2]) != order_fields(row)
+            )
+        
+        per_row = row_write_seconds(self._api_seconds / self._api_calls if self._api_calls else DEFAULT_API_CALL_SECONDS)
+        logger.info(f"書き込み見積もり: 追加・更新 {pending}件 × {per_row:.1f}秒")
+        return pending * per_row
+    
+    def _load_rows_for(self, data_rows):
+        """
+        書き込み対象の行のみを既存データとして読み込む（キー列 + 対象行の2リクエスト）
+        対象外の行はキー列のみのプレースホルダーとし、行番号の対応を保つ
+        
+        Args:
+            data_rows: 書き込むデータ行
+            
+        Returns:
+            既存データ（ヘッダー行は空、対象外の行はキー列のみ）
+        """
+        keys = self._read_keys(self.ws)
+        wanted = {self._row_key(row) for row in data_rows}
+        
+        all_existing_data = [[]]
+        for key in keys:
+            row = [""] * (COL_COLOR_SIZE + 1)
+            row[COL_ORDER_ID], row[COL_ITEM_NAME], row[COL_COLOR_SIZE] = key
+            all_existing_data.append(row)
+        
+        indices = [idx for idx, key in enumerate(keys, start=1) if key in wanted]
+        if indices:
+            last_col = chr(64 + DEFAULT_NUM_COLS)
+            ranges = [f"A{idx + 1}:{last_col}{idx + 1}" for idx in indices]
+            fetched = self._execute_with_retry(self.ws.batch_get, ranges)
+            for idx, value_range in zip(indices, fetched):
+                if value_range:
+                    all_existing_data[idx] = value_range[0]
+        return all_existing_data
     
-    def write(self, values):
+    def write(self, values, deadline=None, lightweight=False):
         """
         注文番号がすでに記載されている場合はその行を更新、
         ない場合は追記
         書き込み後、テーブル範囲を自動的に拡張
         
         Args:
-            values: 書き込むデータ（ヘッダー行を含む）
+            values: 書き込むデータ（ヘッダー行を含む、優先度順）
+            deadline: 書き込みを打ち切る時刻（time.monotonic基準）。残りの行は次回の実行に回す
+            lightweight: Trueの場合、シート全体を読み込まず対象行のみを読み込み、アーカイブも行わない
+                （HTTPサービスモードで少数の注文を更新する場合）
         """
         if not values:
             logger.warning("書き込むデータがありません")
@@ -328,28 +760,52 @@ class GSheet:
         data_rows = values[1:]
         logger.info(f"Google Sheetsへの書き込み開始: 全{len(data_rows)}件")
         
-        # 全既存データを一度に取得（Readリクエストを削減）
-        logger.info("既存データを取得中...")
-        all_existing_data = self._execute_with_retry(self.ws.get_all_values)
+        # 全既存データとアーカイブ済みのキーを一度に取得（Readリクエストを削減）
+        # 事前取得したデータは、取得後にシートが変更されていない場合のみ使用する
+        all_existing_data = None
+        if lightweight:
+            all_existing_data = self._load_rows_for(data_rows)
+            archived_keys = self._load_archived_keys() if self.archive_days > 0 else set()
+        elif self._prefetched is not None:
+            prefetched, archived_keys = self._prefetched
+            self._prefetched = None
+            if self._is_snapshot_current(prefetched):
+                all_existing_data = prefetched
+            else:
+                logger.info("事前取得後にシートが変更されたため、既存データを再取得します")
+        if all_existing_data is None:
+            logger.info("既存データを取得中...")
+            all_existing_data = self._execute_with_retry(self.ws.get_all_values)
+            archived_keys = self._load_archived_keys() if self.archive_days > 0 else set()
+        
+        # 完了済みの注文をアーカイブに移動（軽量書き込みでは次回の一括書き込みに任せる）
+        if not lightweight:
+            all_existing_data = self.archive_settled_orders(all_existing_data, archived_keys)
+            if all_existing_data and all_existing_data[0]:
+                self._num_cols = len(all_existing_data[0])
         
         # 既存データから複合キー（注文番号+商品名+色サイズ）とその行インデックスを作成
         existing_keys = {}  # {(order_id, item_name, color_size): row_index}
         for idx, row in enumerate(all_existing_data):
             if len(row) > COL_COLOR_SIZE:
-                key = (
-                    row[COL_ORDER_ID] if len(row) > COL_ORDER_ID else "",
-                    row[COL_ITEM_NAME] if len(row) > COL_ITEM_NAME else "",
-                    row[COL_COLOR_SIZE] if len(row) > COL_COLOR_SIZE else ""
-                )
-                existing_keys[key] = idx + 1  # 行番号は1から始まる
+                existing_keys[self._row_key(row)] = idx + 1  # 行番号は1から始まる
         
         max_row = len(all_existing_data)  # 現在の最大行を記録
+        throttle = len(data_rows) > SMALL_WRITE_MAX_ROWS  # 少数の書き込みはクォータ回避の待機を行わない
         processed_count = 0
         updated_count = 0
         added_count = 0
         skipped_count = 0
+        archived_count = 0
+        deferred_count = 0
         
         for i, row_data in enumerate(data_rows):
+            if deadline is not None and time.monotonic() >= deadline:
+                deferred_count = len(data_rows) - i
+                logger.warning(f"実行時間の予算に達したため、残り{deferred_count}件の書き込みを次回に回します")
+                break
+            
+            processed_before = processed_count
             order_id = row_data[COL_ORDER_ID]  # 注文番号
             item_name = row_data[COL_ITEM_NAME] if len(row_data) > COL_ITEM_NAME else ""
             color_size = row_data[COL_COLOR_SIZE] if len(row_data) > COL_COLOR_SIZE else ""
@@ -364,30 +820,40 @@ class GSheet:
                 
                 # 値が変わっている場合のみ更新
                 if self._should_update_row(row_index, row_data, all_existing_data):
-                    # 既存の到着日を取得
+                    # 既存の行との差分を変更イベントとして記録
                     existing_row = all_existing_data[row_index - 1]
-                    old_arrival_date = existing_row[COL_ARRIVAL_DATE] if len(existing_row) > COL_ARRIVAL_DATE else ""
+                    changes = self._diff_row(data_key, existing_row, row_data)
                     
-                    self._update_existing_order(row_index, row_data, order_id, new_arrival_date, old_arrival_date)
+                    self._update_existing_order(row_index, row_data, order_id)
+                    self._record_changes(changes)
                     processed_count += 1
                     updated_count += 1
                 else:
                     logger.info(f"注文番号 {order_id} ({item_name} / {color_size}) は変更がないためスキップしました")
                     skipped_count += 1
+            elif data_key in archived_keys:
+                # アーカイブ済みの注文はメインシートに再追加しない
+                archived_count += 1
             else:
                 # 新しい組み合わせの場合、追記
                 self._add_new_order(row_data, order_id, new_arrival_date)
+                self._record_changes([make_event(data_key, EVENT_NEW_ITEM, new_value=row_data[0])])
                 max_row += 1  # 新規行が追加されたので行数を増やす
                 processed_count += 1
                 added_count += 1
             
-            # バッチサイズごとに待機してAPIクォータを回避
-            if processed_count > 0 and processed_count % BATCH_SIZE == 0:
+            # バッチサイズごとに待機してAPIクォータを回避（書き込みを行った行でのみ判定）
+            row_written = processed_count > processed_before
+            if throttle and row_written and processed_count % BATCH_SIZE == 0 and i < len(data_rows) - 1:
+                if deadline is not None and time.monotonic() + BATCH_WAIT_TIME >= deadline:
+                    deferred_count = len(data_rows) - i - 1
+                    logger.warning(f"実行時間の予算に達したため、残り{deferred_count}件の書き込みを次回に回します")
+                    break
                 logger.info(f"{processed_count}件処理完了。APIクォータ回避のため{BATCH_WAIT_TIME}秒待機します...")
                 time.sleep(BATCH_WAIT_TIME)
         
-        # データ書き込み後、テーブル範囲を拡張
-        if max_row > 0:
+        # データ書き込み後、テーブル範囲を拡張（軽量書き込みでは追記した場合のみ）
+        if max_row > 0 and (added_count or not lightweight):
             self.update_table_range(max_row)
         
         # 統計情報をログに出力
@@ -397,4 +863,7 @@ class GSheet:
         logger.info(f"  新規追加: {added_count}件")
         logger.info(f"  更新: {updated_count}件")
         logger.info(f"  スキップ: {skipped_count}件")
+        logger.info(f"  アーカイブ済み: {archived_count}件")
+        if deferred_count:
+            logger.warning(f"  次回に回した件数: {deferred_count}件")
         logger.info("=" * 50)
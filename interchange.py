@@ -0,0 +1,86 @@
+"""
+ステージ間のデータ受け渡しモジュール
+scrape / enrich / write の各ステージはJSON Lines形式（1行1レコード）のファイルでデータを受け渡す
+"""
+import os
+import sys
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 標準入出力を表すパス
+STDIO_PATH = "-"
+
+
+def write_records(path, records):
+    """
+    レコードをJSON Lines形式でストリーミング書き込み
+    途中で失敗しても既存ファイルを壊さないよう、一時ファイルに書いてから置き換える
+
+    Args:
+        path: 出力ファイルパス（"-" の場合は標準出力）
+        records: 書き込むレコード（dictのイテラブル）
+
+    Returns:
+        int: 書き込んだレコード数
+    """
+    count = 0
+    if path == STDIO_PATH:
+        for record in records:
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+        sys.stdout.flush()
+        return count
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                count += 1
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logger.info(f"{count}件のレコードを {path} に書き込みました")
+    return count
+
+
+def read_records(path):
+    """
+    JSON Lines形式のファイルからレコードを1件ずつ読み込み
+
+    Args:
+        path: 入力ファイルパス（"-" の場合は標準入力）
+
+    Yields:
+        Dict: レコード
+    """
+    if path == STDIO_PATH:
+        yield from _iter_lines(sys.stdin, "<stdin>")
+        return
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"入力ファイルが見つかりません: {path}")
+
+    with open(path, "r", encoding="utf-8") as f:
+        yield from _iter_lines(f, path)
+
+
+def _iter_lines(stream, name):
+    """ストリームの各行をJSONとしてパース（空行は無視）"""
+    for line_no, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{name} の{line_no}行目を読み込めません: {e}") from e
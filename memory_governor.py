@@ -0,0 +1,295 @@
+"""
+メモリ監視による並列数制御モジュール
+コンテナ（cgroup）のメモリ使用量を計測し、詳細ページの同時取得数を調整する
+cgroupが読めない環境では、Pythonプロセスとブラウザのプロセスツリーの合計PSSを使う
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from env_config import env_float
+
+logger = logging.getLogger(__name__)
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_MEMORY_LIMIT_MB = 2048  # コンテナのメモリ上限（Cloud Run: 2Gi）
+DEFAULT_SOFT_RATIO = 0.70  # この割合を超えたら同時取得数を下げる
+DEFAULT_CRITICAL_RATIO = 0.85  # この割合を超えたらコンテキストを作り直す
+DEFAULT_MAX_CONCURRENCY = 10  # 最大同時取得数
+RECOVER_RATIO = 0.55  # この割合を下回ったら同時取得数を1ずつ戻す
+ADJUST_INTERVAL = 2.0  # 同時取得数を調整する最小間隔（秒）
+RECYCLE_COOLDOWN = 30.0  # 回復処理（コンテキストの作り直し）の最小間隔（秒）
+PHASE_SAMPLE_INTERVAL = 0.5  # フェーズ実行中にピークを計測する間隔（秒）
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+# cgroupのメモリ使用量（v2 / v1）。Cloud Runはこの値でメモリ上限を判定する
+CGROUP_MEMORY_FILES = [
+    ("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.stat", "inactive_file"),
+    ("/sys/fs/cgroup/memory/memory.usage_in_bytes", "/sys/fs/cgroup/memory/memory.stat", "total_inactive_file"),
+]
+
+
+def cgroup_memory_mb():
+    """
+    コンテナ（cgroup）のワーキングセット（使用量 − 回収可能なページキャッシュ）を取得
+
+    Returns:
+        float: ワーキングセット（MB）。cgroupが読めない環境ではNone
+    """
+    for usage_path, stat_path, inactive_key in CGROUP_MEMORY_FILES:
+        try:
+            with open(usage_path, "r") as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        inactive = 0
+        try:
+            with open(stat_path, "r") as f:
+                for line in f:
+                    key, _, value = line.partition(" ")
+                    if key == inactive_key:
+                        inactive = int(value)
+                        break
+        except (OSError, ValueError):
+            pass
+        return max(0, usage - inactive) / (1024 * 1024)
+    return None
+
+
+def _read_pss_bytes(pid):
+    """
+    /proc からプロセスのPSS（共有ページをプロセス数で按分したメモリ、バイト）を取得
+    smaps_rollup が読めない場合はRSS、どちらも取得できない場合は0
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _list_children():
+    """/proc を走査して {親PID: [子PID, ...]} を作成"""
+    children = {}
+    try:
+        pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return children
+
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm にはスペースや括弧が含まれ得るため、最後の ")" 以降をパースする
+        fields = stat[stat.rfind(")") + 2:].split()
+        if len(fields) > 1:
+            children.setdefault(int(fields[1]), []).append(pid)
+    return children
+
+
+def process_tree_pss_mb(root_pid=None):
+    """
+    プロセスとその全子孫プロセス（Chromium等）の合計PSSを取得
+    RSSの合計ではChromiumの多数のプロセスが共有するライブラリ・共有メモリを重複して数えるため、PSSを使う
+
+    Args:
+        root_pid: ルートプロセスのPID（デフォルトは自プロセス）
+
+    Returns:
+        float: 合計PSS（MB）。/proc が使えない環境では0
+    """
+    root_pid = root_pid or os.getpid()
+    children = _list_children()
+    total = 0
+    stack = [root_pid]
+    seen = set()
+    while stack:
+        pid = stack.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        total += _read_pss_bytes(pid)
+        stack.extend(children.get(pid, []))
+    return total / (1024 * 1024)
+
+
+def memory_usage_mb():
+    """
+    メモリ使用量を取得（cgroupのワーキングセット、読めない場合はプロセスツリーの合計PSS）
+
+    Returns:
+        float: メモリ使用量（MB）
+    """
+    mb = cgroup_memory_mb()
+    return mb if mb is not None else process_tree_pss_mb()
+
+
+class MemoryGovernor:
+    """メモリ使用量に応じて同時取得数を調整するクラス"""
+
+    def __init__(self, limit_mb=DEFAULT_MEMORY_LIMIT_MB, soft_ratio=DEFAULT_SOFT_RATIO,
+                 critical_ratio=DEFAULT_CRITICAL_RATIO, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """
+        初期化
+
+        Args:
+            limit_mb: メモリ上限（MB）
+            soft_ratio: 同時取得数を下げ始める使用率
+            critical_ratio: コンテキストを作り直す使用率
+            max_concurrency: 最大同時取得数
+        """
+        self.limit_mb = limit_mb
+        self.soft_mb = limit_mb * soft_ratio
+        self.critical_mb = limit_mb * critical_ratio
+        self.recover_mb = limit_mb * RECOVER_RATIO
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.concurrency = self.max_concurrency
+
+        self.last_mb = 0.0
+        self._last_adjust = 0.0
+        self._last_recycle = 0.0
+        self.phase_peaks = {}  # {フェーズ名: ピークメモリ（MB）}
+        self._current_phase = None
+        self._peak_lock = threading.Lock()  # フェーズごとの計測スレッドと共有
+
+    @classmethod
+    def from_env(cls):
+        """環境変数から設定を読み込んで生成"""
+        return cls(
+            limit_mb=env_float("YIWU_MEMORY_LIMIT_MB", DEFAULT_MEMORY_LIMIT_MB),
+            soft_ratio=env_float("YIWU_MEMORY_SOFT_RATIO", DEFAULT_SOFT_RATIO),
+            critical_ratio=env_float("YIWU_MEMORY_CRITICAL_RATIO", DEFAULT_CRITICAL_RATIO),
+            max_concurrency=env_float("YIWU_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY),
+        )
+
+    def sample(self):
+        """
+        現在のメモリ使用量を計測し、同時取得数を調整
+
+        Returns:
+            float: メモリ使用量（MB）
+        """
+        mb = memory_usage_mb()
+        self.last_mb = mb
+        if self._current_phase is not None:
+            self._record_peak(self._current_phase, mb)
+
+        now = time.monotonic()
+        if now - self._last_adjust < ADJUST_INTERVAL:
+            return mb
+
+        if mb >= self.soft_mb and self.concurrency > 1:
+            # しきい値を超えたら半減させ、余裕ができたら1ずつ戻す
+            self.concurrency = max(1, self.concurrency // 2)
+            self._last_adjust = now
+            logger.warning(f"メモリ使用量 {mb:.0f}MB / {self.limit_mb:.0f}MB。同時取得数を{self.concurrency}に下げます")
+        elif mb < self.recover_mb and self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self._last_adjust = now
+        return mb
+
+    def should_recycle(self):
+        """直近の計測値が危険域で、回復処理を行ってよいかどうか"""
+        if self.last_mb < self.critical_mb:
+            return False
+        return time.monotonic() - self._last_recycle >= RECYCLE_COOLDOWN
+
+    def _record_peak(self, name, mb):
+        """フェーズのピークメモリを更新"""
+        with self._peak_lock:
+            self.phase_peaks[name] = max(self.phase_peaks.get(name, 0.0), mb)
+
+    @contextmanager
+    def phase(self, name, interval=PHASE_SAMPLE_INTERVAL):
+        """
+        フェーズ単位でピークメモリを記録し、終了時にログ出力
+        フェーズ実行中は別スレッドで定期的に計測する（開始・終了時の計測だけではピークを取りこぼすため）
+
+        Args:
+            name: フェーズ名
+            interval: 計測間隔（秒）
+        """
+        previous = self._current_phase
+        self._current_phase = name
+        self.sample()
+
+        stop = threading.Event()
+
+        def monitor():
+            while not stop.wait(interval):
+                self._record_peak(name, memory_usage_mb())
+
+        thread = threading.Thread(target=monitor, name=f"memory-{name}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self.sample()
+            self._current_phase = previous
+            logger.info(f"[メモリ] {name}: ピーク {self.phase_peaks.get(name, 0.0):.0f}MB / {self.limit_mb:.0f}MB")
+
+    async def run(self, items, worker, on_critical=None, should_stop=None, interval=1.0):
+        """
+        メモリ使用量に応じた同時実行数でワーカーを実行
+
+        Args:
+            items: 処理対象のリスト（優先度順）
+            worker: 1件を処理するコルーチン関数 worker(item)
+            on_critical: 危険域に達したとき、実行中の処理が完了してから呼ばれるコルーチン関数
+            should_stop: Trueを返したら未開始の処理を開始しない関数（実行中の処理は完了まで待つ）
+            interval: 実行中にメモリを計測する間隔（秒）
+
+        Returns:
+            Dict: {item: 結果または例外}（開始しなかったitemは含まれない）
+        """
+        results = {}
+        pending = list(items)
+        running = {}  # {タスク: item}
+
+        while pending or running:
+            self.sample()
+
+            if on_critical is not None and self.should_recycle():
+                # 新規取得を止め、実行中のページが閉じるのを待ってからコンテキストを作り直す
+                logger.warning(f"メモリ使用量が危険域です（{self.last_mb:.0f}MB）。実行中の{len(running)}件の完了を待って回復処理を行います")
+                if running:
+                    await asyncio.wait(running.keys())
+                    self._collect(running, results)
+                await on_critical()
+                self._last_recycle = time.monotonic()
+                self.sample()
+
+            if pending and should_stop is not None and should_stop():
+                pending = []
+
+            while pending and len(running) < self.concurrency:
+                item = pending.pop(0)
+                running[asyncio.ensure_future(worker(item))] = item
+
+            if running:
+                await asyncio.wait(running.keys(), timeout=interval, return_when=asyncio.FIRST_COMPLETED)
+                self._collect(running, results)
+
+        return results
+
+    @staticmethod
+    def _collect(running, results):
+        """完了したタスクの結果を回収"""
+        for task in [t for t in running if t.done()]:
+            item = running.pop(task)
+            results[item] = task.exception() or task.result()
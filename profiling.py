@@ -0,0 +1,206 @@
+"""
+プロファイリングモジュール
+環境変数 YIWU_PROFILE=true で有効化し、以下の成果物を YIWU_PROFILE_DIR に出力する
+
+- サンプリングプロファイラによるスタック集計（collapsed形式: speedscope / flamegraph.pl で読み込み可能）
+- 詳細ページの一部に対するPlaywrightトレース（playwright show-trace で表示可能）
+- ホットパス関数の呼び出し回数・所要時間（JSON）
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import functools
+import asyncio
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# デフォルト設定
+DEFAULT_PROFILE_DIR = "profiles"
+DEFAULT_SAMPLE_INTERVAL = 0.005  # サンプリング間隔（秒）
+DEFAULT_TRACE_SAMPLE_RATE = 0.05  # Playwrightトレースを取得する詳細ページの割合
+
+
+class _State:
+    """プロファイリングの設定と集計値"""
+
+    def __init__(self):
+        self.enabled = False
+        self.profile_dir = DEFAULT_PROFILE_DIR
+        self.sample_interval = DEFAULT_SAMPLE_INTERVAL
+        self.trace_sample_rate = 0.0
+        self.timers = {}  # {関数名: [呼び出し回数, 合計秒, 最大秒]}
+        self.lock = threading.Lock()
+
+
+_state = _State()
+
+
+def configure():
+    """環境変数からプロファイリング設定を読み込み"""
+    _state.enabled = os.environ.get("YIWU_PROFILE", "false").lower() in ("true", "1", "yes")
+    _state.profile_dir = os.environ.get("YIWU_PROFILE_DIR", DEFAULT_PROFILE_DIR)
+    try:
+        _state.sample_interval = float(os.environ.get("YIWU_PROFILE_INTERVAL", DEFAULT_SAMPLE_INTERVAL))
+        _state.trace_sample_rate = float(os.environ.get("YIWU_TRACE_SAMPLE_RATE", DEFAULT_TRACE_SAMPLE_RATE))
+    except ValueError as e:
+        logger.warning(f"プロファイリング設定が不正です。デフォルト値を使用します: {e}")
+        _state.sample_interval = DEFAULT_SAMPLE_INTERVAL
+        _state.trace_sample_rate = DEFAULT_TRACE_SAMPLE_RATE
+    return _state.enabled
+
+
+def is_enabled():
+    """プロファイリングが有効かどうか"""
+    return _state.enabled
+
+
+def artifact_path(filename):
+    """成果物の出力パスを取得（ディレクトリがなければ作成）"""
+    os.makedirs(_state.profile_dir, exist_ok=True)
+    return os.path.join(_state.profile_dir, filename)
+
+
+def should_trace():
+    """この詳細ページでPlaywrightトレースを取得するかどうか（サンプリング）"""
+    return _state.enabled and random.random() < _state.trace_sample_rate
+
+
+def _record(name, elapsed):
+    """関数の所要時間を集計"""
+    with _state.lock:
+        stats = _state.timers.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+
+def timed(func):
+    """
+    関数の呼び出し回数と所要時間を計測するデコレータ（同期・非同期の両方に対応）
+    プロファイリングが無効の場合は計測せずにそのまま呼び出す
+    """
+    name = func.__qualname__
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return await func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter() - started)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state.enabled:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(name, time.perf_counter() - started)
+    return wrapper
+
+
+class SamplingProfiler:
+    """
+    全スレッドのスタックを一定間隔で取得して集計するサンプリングプロファイラ
+    各スタックの先頭にスレッド名を付けるため、イベントループとシンクの書き込みスレッド
+    （asyncio.to_thread で実行されるSheetsのAPI呼び出し・待機）を区別できる
+    asyncioのイベントループが待機中のサンプルは selector の select に集計されるため、
+    Python CPU時間とネットワーク・CDP待ちを区別できる
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """サンプリングを開始"""
+        self._thread = threading.Thread(target=self._loop, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """サンプリングを停止"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, f"thread-{thread_id}"))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def write_collapsed(self, path):
+        """collapsed形式（1行に「スタック;... サンプル数」）で出力"""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def write_timer_report(path):
+    """ホットパス関数の集計結果をJSONで出力し、ログにも出力"""
+    with _state.lock:
+        report = {
+            name: {"calls": calls, "total_sec": round(total, 3), "avg_sec": round(total / calls, 4),
+                   "max_sec": round(maximum, 3)}
+            for name, (calls, total, maximum) in _state.timers.items()
+        }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for name, stats in sorted(report.items(), key=lambda kv: -kv[1]["total_sec"]):
+        logger.info(f"[計測] {name}: {stats['calls']}回 合計{stats['total_sec']}秒 "
+                    f"平均{stats['avg_sec']}秒 最大{stats['max_sec']}秒")
+
+
+@contextmanager
+def session(name):
+    """
+    プロファイリングが有効な場合、ブロック全体をサンプリングして成果物を出力
+
+    Args:
+        name: 成果物のファイル名に含める実行名（コマンド名など）
+    """
+    if not configure():
+        yield
+        return
+
+    prefix = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    profiler = SamplingProfiler(interval=_state.sample_interval)
+    logger.info(f"プロファイリングを開始します（出力先: {_state.profile_dir}）")
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        try:
+            profiler.write_collapsed(artifact_path(f"{prefix}.folded"))
+            write_timer_report(artifact_path(f"{prefix}-timers.json"))
+            logger.info(f"プロファイリング結果を出力しました: {profiler.sample_count}サンプル → {_state.profile_dir}/{prefix}.*")
+        except Exception as e:
+            logger.error(f"プロファイリング結果の出力エラー: {e}")
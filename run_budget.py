@@ -0,0 +1,147 @@
+"""
+実行時間の予算管理モジュール
+Cloud Run Jobのタイムアウト（timeoutSeconds）までに必ず書き込みが行われるよう、
+処理ごとの所要時間を記録して残り作業を見積もり、低優先度の処理を見送る
+"""
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# デフォルト設定（環境変数で上書き可能）
+DEFAULT_TIME_BUDGET = 3600  # 実行時間の予算（秒）。job.yaml の timeoutSeconds に合わせる
+DEFAULT_FLUSH_RESERVE = 600  # 書き込み用に確保する最小時間（秒）
+WRITE_SAFETY_MARGIN = 60  # タイムアウト直前に書き込みを打ち切るための余裕（秒）
+MAX_FLUSH_RATIO = 0.5  # 書き込み用に確保する時間の上限（予算に対する割合）。超える分は書き込み側で次回に回す
+
+
+class RunBudget:
+    """実行時間の予算を管理するクラス"""
+
+    def __init__(self, total_seconds=DEFAULT_TIME_BUDGET, flush_reserve=DEFAULT_FLUSH_RESERVE):
+        """
+        初期化
+
+        Args:
+            total_seconds: 実行時間の予算（秒）。0以下の場合は無制限
+            flush_reserve: 書き込み用に確保する最小時間（秒）。reserve_for_writes の見積もりがこれを超える場合は見積もりを使う
+        """
+        self.started = time.monotonic()
+        self.enabled = total_seconds > 0
+        self.total_seconds = total_seconds
+        self.deadline = self.started + total_seconds
+        self.min_flush_reserve = flush_reserve
+        self.flush_reserve = flush_reserve
+
+        self.timings = {}  # {処理の種類: [回数, 合計秒]}
+        self.deferred = {}  # {見送った処理の種類: [ラベル, ...]}
+
+    @classmethod
+    def from_env(cls, writes=True):
+        """
+        環境変数から設定を読み込んで生成
+
+        Args:
+            writes: Falseの場合は書き込みを行わない実行（scrape / enrich ステージ）として、書き込み用の時間を確保しない
+        """
+        try:
+            total_seconds = float(os.environ.get("YIWU_TIME_BUDGET_SECONDS", DEFAULT_TIME_BUDGET))
+            flush_reserve = float(os.environ.get("YIWU_FLUSH_RESERVE_SECONDS", DEFAULT_FLUSH_RESERVE))
+        except ValueError as e:
+            logger.warning(f"実行時間の予算設定が不正です。デフォルト値を使用します: {e}")
+            total_seconds, flush_reserve = DEFAULT_TIME_BUDGET, DEFAULT_FLUSH_RESERVE
+        return cls(total_seconds, flush_reserve if writes else 0)
+
+    def time_before_flush(self):
+        """書き込み開始予定時刻までの残り時間（秒）"""
+        if not self.enabled:
+            return float("inf")
+        return self.deadline - self.flush_reserve - time.monotonic()
+
+    def reserve_for_writes(self, seconds):
+        """
+        書き込みの見積もり時間に応じて、書き込み用に確保する時間を更新
+
+        Args:
+            seconds: 書き込みの見積もり時間（秒）
+        """
+        if not self.enabled:
+            return
+        reserve = max(self.min_flush_reserve, seconds + WRITE_SAFETY_MARGIN)
+        self.flush_reserve = min(reserve, self.total_seconds * MAX_FLUSH_RATIO)
+        logger.info(f"[実行時間] 書き込み見積もり {seconds:.0f}秒 → 書き込み用に{self.flush_reserve:.0f}秒を確保します")
+
+    def write_deadline(self):
+        """書き込みを打ち切る時刻（time.monotonic基準、無制限の場合はNone）"""
+        if not self.enabled:
+            return None
+        return self.deadline - WRITE_SAFETY_MARGIN
+
+    def record(self, kind, seconds):
+        """処理の所要時間を記録"""
+        stats = self.timings.setdefault(kind, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def average(self, kind, default):
+        """処理の平均所要時間（記録がない場合はdefault）"""
+        count, total = self.timings.get(kind, (0, 0.0))
+        return total / count if count else default
+
+    def estimate(self, kind, count, default, concurrency=1):
+        """
+        残りの処理にかかる時間を見積もり
+
+        Args:
+            kind: 処理の種類
+            count: 残りの件数
+            default: 記録がない場合の1件あたりの所要時間（秒）
+            concurrency: 同時実行数
+
+        Returns:
+            float: 見積もり時間（秒）
+        """
+        return self.average(kind, default) * count / max(1, concurrency)
+
+    def affordable(self, kind, default, concurrency=1):
+        """
+        書き込み開始予定時刻までに処理できる件数を見積もり
+
+        Args:
+            kind: 処理の種類
+            default: 記録がない場合の1件あたりの所要時間（秒）
+            concurrency: 同時実行数
+
+        Returns:
+            int: 処理できる件数（無制限の場合はNone）
+        """
+        if not self.enabled:
+            return None
+        remaining = max(0.0, self.time_before_flush())
+        return int(remaining * max(1, concurrency) / max(self.average(kind, default), 1e-3))
+
+    def can_start(self, expected_seconds):
+        """書き込み開始予定時刻までに、expected_seconds かかる処理を終えられるかどうか"""
+        return self.time_before_flush() > expected_seconds
+
+    def defer(self, kind, labels):
+        """見送った処理を記録"""
+        if labels:
+            self.deferred.setdefault(kind, []).extend(labels)
+
+    def log_summary(self):
+        """実行時間と見送った処理の概要をログに出力"""
+        elapsed = time.monotonic() - self.started
+        budget = f"{self.total_seconds:.0f}秒" if self.enabled else "無制限"
+        logger.info(f"[実行時間] 経過 {elapsed:.0f}秒 / 予算 {budget}")
+        for kind, (count, total) in self.timings.items():
+            logger.info(f"  {kind}: {count}件 平均{total / count:.1f}秒")
+
+        if not self.deferred:
+            logger.info("  見送った処理: なし")
+            return
+        for kind, labels in self.deferred.items():
+            preview = ", ".join(str(label) for label in labels[:20])
+            more = f" ほか{len(labels) - 20}件" if len(labels) > 20 else ""
+            logger.warning(f"  見送った処理（{kind}）: {len(labels)}件 [{preview}{more}] → 次回の実行で処理されます")
@@ -0,0 +1,299 @@
+"""
+HTTPサービスモード
+ログイン済みのブラウザコンテキストとGSheetクライアントを常駐させ、注文の更新をオンデマンドで実行する
+
+起動方法:
+    functions-framework --target=handle --source=service.py --port=8080
+
+エンドポイント:
+    GET/POST /refresh/order?orderId=...       注文番号を指定して1注文を更新
+    GET/POST /refresh/order?detailLink=...    詳細リンクを指定して1注文を更新
+    GET/POST /refresh/pages?n=3               最新のNページを更新
+    GET/POST /sync                            全件同期を開始（wait=true で完了まで待機）
+    GET      /healthz                         ヘルスチェック
+"""
+import os
+import asyncio
+import logging
+import threading
+from contextlib import AsyncExitStack
+from urllib.parse import urljoin
+import functions_framework
+import google_sheet
+from data_processor import DataProcessor
+from run_budget import RunBudget
+from yiwu_scraper import YiwuScraper
+
+logger = logging.getLogger(__name__)
+
+# 注文番号・詳細リンク指定時に検索する最大ページ数（新しい順）
+MAX_SEARCH_PAGES = int(os.environ.get("YIWU_SERVICE_MAX_SEARCH_PAGES", "10"))
+# /refresh/pages で指定できる最大ページ数
+MAX_REFRESH_PAGES = int(os.environ.get("YIWU_SERVICE_MAX_REFRESH_PAGES", "20"))
+# 同期リクエストの待機上限（秒）
+REQUEST_TIMEOUT = int(os.environ.get("YIWU_SERVICE_REQUEST_TIMEOUT", "3000"))
+
+
+class ScraperService:
+    """ブラウザとGSheetクライアントを常駐させて更新リクエストを処理するクラス"""
+
+    def __init__(self):
+        self.scraper = YiwuScraper()
+        # 常駐プロセスのため実行時間の予算は使わない
+        self.scraper.budget = RunBudget(total_seconds=0)
+        self.context = None
+        self.sheet = None
+        self._stack = None
+        self._ready_lock = None
+        self._write_lock = None
+        self._inflight = {}  # {リクエストキー: 実行中のタスク}
+
+        # 常駐用のイベントループを専用スレッドで動かす（HTTPハンドラは別スレッドから投入する）
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="scraper-service", daemon=True)
+        self.thread.start()
+
+    def submit(self, coro, wait=True):
+        """
+        常駐ループでコルーチンを実行
+
+        Args:
+            coro: 実行するコルーチン
+            wait: Trueの場合は完了まで待機して結果を返す
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if not wait:
+            return future
+        return future.result(timeout=REQUEST_TIMEOUT)
+
+    async def _ensure_ready(self):
+        """ブラウザのログインとGSheetクライアントの初期化（未初期化・切断時のみ）"""
+        if self._ready_lock is None:
+            self._ready_lock = asyncio.Lock()
+            self._write_lock = asyncio.Lock()
+
+        async with self._ready_lock:
+            if self.context is not None and self.context.browser.is_connected():
+                return
+
+            await self._reset()
+            logger.info("常駐ブラウザとGoogle Sheetsクライアントを初期化中...")
+            stack = AsyncExitStack()
+            # ログインとGSheetの認証を並行して実行
+            session_task = asyncio.ensure_future(stack.enter_async_context(self.scraper.browser_session()))
+            tasks = [session_task]
+            if self.sheet is None:
+                tasks.append(asyncio.ensure_future(asyncio.to_thread(google_sheet.GSheet)))
+            try:
+                (context, _), *sheet = await asyncio.gather(*tasks)
+            except BaseException:
+                # 一方が失敗しても他方は継続しているため、キャンセルして終了を待ってからスタックを閉じる
+                # （ログイン中のセッションが閉じた後のスタックに登録され、ブラウザが残るのを防ぐ）
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await stack.aclose()
+                raise
+            if sheet:
+                self.sheet = sheet[0]
+            self._stack = stack
+            self.context = context
+            logger.info("初期化完了")
+
+    async def _reset(self):
+        """常駐ブラウザを破棄（次のリクエストで再初期化される）"""
+        if self._stack is not None:
+            try:
+                await self._stack.aclose()
+            except Exception as e:
+                logger.warning(f"ブラウザの終了でエラー: {e}")
+        self._stack = None
+        self.context = None
+
+    async def _coalesce(self, key, factory):
+        """
+        同じキーのリクエストが実行中であればその結果を共有する
+
+        Args:
+            key: リクエストキー
+            factory: 実行するコルーチンを返す関数
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(factory))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            logger.info(f"実行中のリクエスト {key} に合流します")
+        # 待機側がキャンセルされても共有中の実行は継続させる
+        return await asyncio.shield(task)
+
+    async def _run(self, factory):
+        """初期化を確認して処理を実行し、失敗時はブラウザを再初期化対象にする"""
+        await self._ensure_ready()
+        try:
+            return await factory()
+        except Exception:
+            if self.context is not None and not self.context.browser.is_connected():
+                await self._reset()
+            raise
+
+    async def _write(self, results):
+        """結果をGoogle Sheetsに書き込み（書き込みは直列化）"""
+        # 詳細ページを取得できなかった注文は色・サイズ等指定が空のため書き込まない
+        results, deferred = DataProcessor.split_deferred(results)
+        if deferred:
+            logger.warning(f"詳細ページ未取得の{len(deferred)}件は書き込みを見送ります")
+        values = DataProcessor.prepare_google_sheets_data(results)
+        async with self._write_lock:
+            # 対象行のみを読み込む軽量書き込み（アーカイブは定期実行のJobに任せる）
+            await asyncio.to_thread(self.sheet.write, values, lightweight=True)
+
+    def _normalize_link(self, link):
+        """詳細リンクを絶対URLに正規化"""
+        return urljoin(self.scraper.base_url, link.strip()) if link else ""
+
+    async def refresh_order(self, order_id=None, detail_link=None):
+        """
+        1注文を更新
+
+        Args:
+            order_id: 注文番号
+            detail_link: 詳細ページのURL
+
+        Returns:
+            Dict: 処理結果
+        """
+        detail_link = self._normalize_link(detail_link)
+        key = ("order", order_id or "", detail_link)
+        return await self._coalesce(key, lambda: self._refresh_order(order_id, detail_link))
+
+    async def _refresh_order(self, order_id, detail_link):
+        def matches(r):
+            if order_id and r.get("orderId") == order_id:
+                return True
+            return bool(detail_link) and self._normalize_link(r.get("detailLink")) == detail_link
+
+        page = await self.scraper.open_order_history(self.context)
+        try:
+            results = await self.scraper.scrape_all_pages(
+                page, max_pages=MAX_SEARCH_PAGES, stop_when=lambda rs: any(matches(r) for r in rs)
+            )
+        finally:
+            await page.close()
+
+        targets = [r for r in results if matches(r)]
+        if not targets:
+            logger.warning(f"注文が見つかりません（注文番号: {order_id}, 詳細リンク: {detail_link}）")
+            return {"status": "not_found", "orderId": order_id, "detailLink": detail_link}
+
+        await self.scraper.enrich_with_product_links(self.context, targets)
+        await self._write(targets)
+        return {"status": "ok", "orderId": targets[0].get("orderId", ""), "items": len(targets)}
+
+    async def refresh_pages(self, n):
+        """最新のNページを更新"""
+        return await self._coalesce(("pages", n), lambda: self._refresh_pages(n))
+
+    async def _refresh_pages(self, n):
+        page = await self.scraper.open_order_history(self.context)
+        try:
+            results = await self.scraper.scrape_all_pages(page, max_pages=n)
+        finally:
+            await page.close()
+
+        await self.scraper.enrich_with_product_links(self.context, results)
+        await self._write(results)
+        return {"status": "ok", "pages": n, "items": len(results)}
+
+    async def full_sync(self):
+        """全件同期"""
+        return await self._coalesce(("sync",), lambda: self._refresh_pages(None))
+
+    def is_syncing(self):
+        """全件同期が実行中かどうか"""
+        return ("sync",) in self._inflight
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """サービスインスタンスを取得（初回のみ生成し、バックグラウンドで初期化を開始）"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = ScraperService()
+            warmup = _service.submit(_service._ensure_ready(), wait=False)
+            warmup.add_done_callback(_log_warmup_error)
+        return _service
+
+
+def _log_warmup_error(future):
+    """起動時の初期化エラーをログに出力（次のリクエストで再初期化される）"""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"起動時の初期化に失敗しました: {future.exception()}")
+
+
+def _log_sync_error(future):
+    """バックグラウンドで実行した全件同期のエラーをログに出力"""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"全件同期に失敗しました: {future.exception()}")
+
+
+def _param(request, name):
+    """クエリ文字列またはJSONボディからパラメータを取得"""
+    value = request.args.get(name)
+    if value is None:
+        body = request.get_json(silent=True) or {}
+        value = body.get(name)
+    return value
+
+
+@functions_framework.http
+def handle(request):
+    """HTTPエントリーポイント"""
+    path = request.path.rstrip("/")
+
+    if path in ("", "/healthz"):
+        return {"status": "ok"}, 200
+
+    service = get_service()
+    try:
+        if path == "/refresh/order":
+            order_id = _param(request, "orderId")
+            detail_link = _param(request, "detailLink")
+            if not order_id and not detail_link:
+                return {"status": "error", "message": "orderId または detailLink を指定してください"}, 400
+            result = service.submit(service.refresh_order(order_id=order_id, detail_link=detail_link))
+            return result, 200 if result["status"] == "ok" else 404
+
+        if path == "/refresh/pages":
+            try:
+                n = int(_param(request, "n") or 1)
+            except (TypeError, ValueError):
+                return {"status": "error", "message": "n には整数を指定してください"}, 400
+            if not 1 <= n <= MAX_REFRESH_PAGES:
+                return {"status": "error", "message": f"n は1〜{MAX_REFRESH_PAGES}の範囲で指定してください"}, 400
+            return service.submit(service.refresh_pages(n)), 200
+
+        if path == "/sync":
+            wait = str(_param(request, "wait") or "").lower() in ("true", "1", "yes")
+            if wait:
+                return service.submit(service.full_sync()), 200
+            already_running = service.is_syncing()
+            future = service.submit(service.full_sync(), wait=False)
+            future.add_done_callback(_log_sync_error)
+            return {"status": "running" if already_running else "started"}, 202
+
+        return {"status": "error", "message": f"不明なパスです: {path}"}, 404
+
+    except Exception as e:
+        logger.error(f"リクエスト処理エラー ({path}): {e}")
+        return {"status": "error", "message": str(e)}, 500
+
+
+# 起動時にブラウザとGSheetクライアントを温めておく
+if os.environ.get("YIWU_SERVICE_WARMUP", "true").lower() in ("true", "1", "yes"):
+    get_service()
@@ -0,0 +1,338 @@
+"""
+出力先（シンク）モジュール
+1回のスクレイピング結果を複数の出力先に並行して書き込む。各シンクは独自のバッチ単位で書き込み、
+失敗は他のシンクに影響しない（例: Google Sheetsの書き込みが遅くてもローカルのアーカイブは先に完了する）
+
+出力先は環境変数 YIWU_SINKS（カンマ区切り）で指定する:
+    sheets                               デフォルトのGoogle Sheets（GOOGLE_SHEETS_* の設定）
+    sheets:<スプレッドシートID>:<シート名>   別のスプレッドシート
+    summary[:<シート名>]                   リードタイム集計のサマリーシート（デフォルト: yiwu_summary、失敗しても実行は継続）
+    sqlite[:<パス>]                       SQLiteアーカイブ（デフォルト: data/orders.db）
+    csv[:<パス>]                          CSVスナップショット（デフォルト: data/orders.csv）
+    parquet[:<パス>]                      Parquetスナップショット（デフォルト: data/orders.parquet、pyarrowが必要）
+"""
+import os
+import time
+import importlib.util
+import asyncio
+import logging
+import sqlite3
+import threading
+from data_processor import DataProcessor, RECORD_FIELDS
+from env_config import data_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SINKS = "sheets,summary"
+
+# Parquet出力に使えるpandasのエンジン（requirements.txtには含まない）
+PARQUET_ENGINES = ("pyarrow", "fastparquet")
+
+# ローカル出力のバッチサイズ
+LOCAL_BATCH_SIZE = 500
+
+# ローカル出力の列（レコードのフィールド + 更新日時）
+LOCAL_COLUMNS = RECORD_FIELDS + ["updatedAt"]
+
+
+class Sink:
+    """出力先の基底クラス"""
+
+    def __init__(self, name, required=True):
+        """
+        初期化
+
+        Args:
+            name: 出力先の名前（ログ用）
+            required: Falseの場合、書き込みの失敗をログに出力するのみで実行全体を失敗させない
+        """
+        self.name = name
+        self.required = required
+
+    def prepare(self):
+        """接続・認証などの事前準備（必要なシンクのみ実装）"""
+
+    def estimate_write_seconds(self, results):
+        """
+        書き込みにかかる時間を見積もり（実行時間の予算で書き込み用の時間を確保するため）
+
+        Args:
+            results: スクレイピング結果（詳細ページ取得前でもよい）
+
+        Returns:
+            float: 見積もり時間（秒）。ローカル出力など無視できる場合は0
+        """
+        return 0.0
+
+    def write(self, results, deadline=None):
+        """
+        スクレイピング結果を書き込み
+
+        Args:
+            results: スクレイピング結果（拡張済みレコードのリスト、優先度順）
+            deadline: 書き込みを打ち切る時刻（time.monotonic基準、Noneの場合は無制限）
+        """
+        raise NotImplementedError
+
+
+class GoogleSheetsSink(Sink):
+    """Google Sheetsへの出力（注文番号+商品名+色サイズで更新・追記）"""
+
+    def __init__(self, spreadsheet_id=None, worksheet_name=None):
+        name = "sheets" if not spreadsheet_id else f"sheets:{spreadsheet_id}:{worksheet_name or ''}"
+        super().__init__(name)
+        self.spreadsheet_id = spreadsheet_id
+        self.worksheet_name = worksheet_name
+        self.sheet = None
+        self._lock = threading.Lock()  # サマリーシンクの準備と同時に呼ばれても1回だけ初期化する
+
+    def prepare(self):
+        with self._lock:
+            if self.sheet is None:
+                # gspread / googleapiclient はこのシンクを使う場合のみ読み込む
+                import google_sheet
+                sheet = google_sheet.GSheet(spreadsheet_id=self.spreadsheet_id, worksheet_name=self.worksheet_name)
+                # 既存データの読み込みをスクレイピングと並行して済ませておく
+                sheet.prefetch()
+                self.sheet = sheet
+
+    def estimate_write_seconds(self, results):
+        if self.sheet is None:
+            # 準備が終わっていない場合は既存データと比較せず、全行の書き込みとして見積もる
+            import google_sheet
+            return len(results) * google_sheet.row_write_seconds()
+        return self.sheet.estimate_write_seconds(DataProcessor.prepare_google_sheets_data(results))
+
+    def write(self, results, deadline=None):
+        self.prepare()
+        values = DataProcessor.prepare_google_sheets_data(results)
+        self.sheet.write(values, deadline=deadline)
+
+
+class SummarySink(Sink):
+    """
+    リードタイム集計をサマリーシートに出力（1回のbatchUpdateで置き換え）
+    Google Sheetsの出力先がある場合は、そのスプレッドシートとクライアントを共有する
+    """
+
+    def __init__(self, worksheet_name=None, source=None, required=False):
+        """
+        初期化
+
+        Args:
+            worksheet_name: サマリーシート名（Noneの場合は環境変数 GOOGLE_SHEETS_SUMMARY_WORKSHEET）
+            source: クライアントを共有するGoogleSheetsSink（Noneの場合はデフォルトのスプレッドシートに接続）
+            required: Falseの場合、書き込みの失敗で実行全体を失敗させない（メインシートの書き込みを優先）
+        """
+        self.worksheet_name = worksheet_name or os.environ.get("GOOGLE_SHEETS_SUMMARY_WORKSHEET", "yiwu_summary")
+        super().__init__(f"summary:{self.worksheet_name}", required=required)
+        self.source = source
+        self.sheet = None
+
+    def prepare(self):
+        if self.sheet is None:
+            if self.source is not None:
+                self.source.prepare()
+                self.sheet = self.source.sheet
+            else:
+                import google_sheet
+                self.sheet = google_sheet.GSheet()
+
+    def write(self, results, deadline=None):
+        # pandas / NumPy はサマリーを出力する場合のみ読み込む
+        import analytics
+
+        summary = analytics.compute_summary(results)
+        self.prepare()
+        self.sheet.write_summary(summary, self.worksheet_name)
+
+
+class SqliteSink(Sink):
+    """SQLiteアーカイブへの出力（注文番号+商品名+色サイズで上書き保存）"""
+
+    def __init__(self, path, batch_size=LOCAL_BATCH_SIZE):
+        super().__init__(f"sqlite:{path}")
+        self.path = path
+        self.batch_size = batch_size
+
+    def write(self, results, deadline=None):
+        records = DataProcessor.prepare_records(results)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        columns = ", ".join(LOCAL_COLUMNS)
+        placeholders = ", ".join("?" for _ in LOCAL_COLUMNS)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in LOCAL_COLUMNS if c not in ("orderId", "itemName", "colorSize"))
+        sql = (f"INSERT INTO orders ({columns}) VALUES ({placeholders}) "
+               f"ON CONFLICT (orderId, itemName, colorSize) DO UPDATE SET {updates}")
+
+        conn = sqlite3.connect(self.path)
+        try:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS orders ({', '.join(f'{c} TEXT NOT NULL' for c in LOCAL_COLUMNS)}, "
+                f"PRIMARY KEY (orderId, itemName, colorSize))"
+            )
+            for i in range(0, len(records), self.batch_size):
+                batch = records[i:i + self.batch_size]
+                with conn:
+                    conn.executemany(sql, [[r[c] for c in LOCAL_COLUMNS] for r in batch])
+        finally:
+            conn.close()
+        logger.info(f"[{self.name}] {len(records)}件を保存しました")
+
+
+class DataFrameSink(Sink):
+    """pandasを使ったファイル出力（実行ごとのスナップショット）"""
+
+    def __init__(self, kind, path, batch_size=LOCAL_BATCH_SIZE):
+        super().__init__(f"{kind}:{path}")
+        self.kind = kind
+        self.path = path
+        self.batch_size = batch_size
+
+    def write(self, results, deadline=None):
+        # pandasはローカルファイル出力を使う場合のみ読み込む
+        import pandas as pd
+
+        records = DataProcessor.prepare_records(results)
+        df = pd.DataFrame(records, columns=LOCAL_COLUMNS)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # 途中で失敗しても前回のファイルを壊さないよう、一時ファイルに書いてから置き換える
+        tmp_path = f"{self.path}.tmp"
+        try:
+            if self.kind == "csv":
+                df.to_csv(tmp_path, index=False, chunksize=self.batch_size, encoding="utf-8-sig")
+            else:
+                df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        logger.info(f"[{self.name}] {len(records)}件を保存しました")
+
+
+def build_sinks(spec=None):
+    """
+    出力先の指定からシンクを生成
+
+    Args:
+        spec: カンマ区切りの出力先（Noneの場合は環境変数 YIWU_SINKS）
+
+    Returns:
+        List[Sink]: シンクのリスト
+    """
+    spec = spec or os.environ.get("YIWU_SINKS") or DEFAULT_SINKS
+    sinks = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        kind, _, target = entry.partition(":")
+        kind = kind.lower()
+
+        if kind == "sheets":
+            spreadsheet_id, _, worksheet_name = target.partition(":")
+            sinks.append(GoogleSheetsSink(spreadsheet_id or None, worksheet_name or None))
+        elif kind == "summary":
+            sinks.append(SummarySink(target or None))
+        elif kind == "sqlite":
+            sinks.append(SqliteSink(target or data_path("orders.db")))
+        elif kind in ("csv", "parquet"):
+            # 書き込み時（スクレイピング後）に失敗しないよう、Parquetのエンジンの有無を事前に確認する
+            if kind == "parquet" and not any(importlib.util.find_spec(m) for m in PARQUET_ENGINES):
+                raise ValueError(f"parquetの出力には {' または '.join(PARQUET_ENGINES)} のインストールが必要です: {entry}")
+            sinks.append(DataFrameSink(kind, target or data_path(f"orders.{kind}")))
+        else:
+            raise ValueError(f"不明な出力先です: {entry}（sheets / summary / sqlite / csv / parquet を指定してください）")
+
+    if not sinks:
+        raise ValueError("出力先が指定されていません")
+
+    # サマリーは最初のGoogle Sheetsの出力先と同じスプレッドシートに書き込み、認証・接続を共有する
+    sheets_sink = next((sink for sink in sinks if isinstance(sink, GoogleSheetsSink)), None)
+    for sink in sinks:
+        if isinstance(sink, SummarySink):
+            sink.source = sheets_sink
+    return sinks
+
+
+def estimate_write_seconds(sinks, results):
+    """
+    すべてのシンクへの書き込みにかかる時間を見積もり（シンクは並行して書き込むため最大値）
+
+    Args:
+        sinks: シンクのリスト
+        results: スクレイピング結果
+
+    Returns:
+        float: 見積もり時間（秒）
+    """
+    estimates = []
+    for sink in sinks:
+        try:
+            estimates.append(sink.estimate_write_seconds(results))
+        except Exception as e:
+            logger.warning(f"[{sink.name}] 書き込み時間の見積もりに失敗しました: {e}")
+    return max(estimates, default=0.0)
+
+
+async def prepare_sinks(sinks):
+    """
+    すべてのシンクの事前準備（認証・既存データの取得など）を並行して実行
+    一部のシンクの失敗はここでログに出力し、書き込み時に改めて報告する
+
+    Args:
+        sinks: シンクのリスト
+
+    Raises:
+        RuntimeError: すべてのシンクの準備に失敗した場合（書き込み先がないためスクレイピングしても無駄になる）
+    """
+    async def run(sink):
+        try:
+            await asyncio.to_thread(sink.prepare)
+            return None
+        except Exception as e:
+            logger.error(f"[{sink.name}] 準備エラー: {e}")
+            return e
+
+    errors = await asyncio.gather(*(run(sink) for sink in sinks))
+    if all(error is not None for error in errors):
+        raise RuntimeError(f"すべての出力先の準備に失敗しました: {errors[0]}") from errors[0]
+
+
+async def write_to_sinks(sinks, results, deadline=None):
+    """
+    すべてのシンクに並行して書き込み（各シンクは別スレッドで実行し、失敗は互いに影響しない）
+
+    Args:
+        sinks: シンクのリスト
+        results: スクレイピング結果
+        deadline: 書き込みを打ち切る時刻（time.monotonic基準、Noneの場合は無制限）
+
+    Raises:
+        RuntimeError: 必須のシンクが失敗した場合（他のシンクの書き込み完了後）
+    """
+    async def run(sink):
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(sink.write, results, deadline)
+            logger.info(f"[{sink.name}] 書き込み完了（{time.monotonic() - started:.1f}秒）")
+            return None
+        except Exception as e:
+            logger.error(f"[{sink.name}] 書き込みエラー: {e}")
+            return e
+
+    logger.info(f"{len(sinks)}件の出力先に書き込みます: {', '.join(s.name for s in sinks)}")
+    errors = await asyncio.gather(*(run(sink) for sink in sinks))
+
+    failed = [sink.name for sink, error in zip(sinks, errors) if error is not None and sink.required]
+    optional_failed = [sink.name for sink, error in zip(sinks, errors) if error is not None and not sink.required]
+    if optional_failed:
+        logger.warning(f"任意の出力先への書き込みに失敗しました（実行は継続）: {', '.join(optional_failed)}")
+    if failed:
+        raise RuntimeError(f"出力先への書き込みに失敗しました: {', '.join(failed)}")
@@ -0,0 +1,23 @@
+"""analytics.compute_summary のテスト"""
+from datetime import datetime
+import analytics
+
+
+def _order(order_id, status, ordered_at):
+    return {"orderId": order_id, "status": status, "orderedAt": ordered_at, "itemName": "item"}
+
+
+def _overdue_ids(values):
+    """サマリーの遅延注文一覧から注文番号を取得"""
+    start = next(i for i, row in enumerate(values) if row and row[0] == "注文番号") + 1
+    return [row[0] for row in values[start:]]
+
+
+def test_overdue_excludes_settled_orders():
+    results = [
+        _order("1001", "キャンセル", "2024-01-01"),
+        _order("1002", "買付中", "2024-01-01"),
+    ]
+    values = analytics.compute_summary(results, overdue_days=30, now=datetime(2024, 6, 1))
+
+    assert _overdue_ids(values) == ["1002"]
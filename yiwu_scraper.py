@@ -1,13 +1,23 @@
 """
 イーウーパスポート スクレイピングアプリケーション
 """
+import argparse
 import asyncio
 import logging
+import time
+from contextlib import asynccontextmanager
 from urllib.parse import urljoin
-from playwright.async_api import async_playwright
 import os
 from dotenv import load_dotenv
-import google_sheet
+import interchange
+import profiling
+import sinks
+from fetch_policy import FetchPolicy
+from memory_governor import MemoryGovernor
+from run_budget import RunBudget
+from data_processor import DataProcessor
+from change_log import ChangeLog
+from env_config import data_path
 
 # 環境変数ファイルを読み込み
 load_dotenv()
@@ -16,6 +26,9 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 詳細ページ1件の取得時間（実測値がない場合の見積もり、秒）
+DEFAULT_DETAIL_SECONDS = 5.0
+
 
 class YiwuScraper:
     """イーウーパスポート スクレイピングクラス"""
@@ -31,6 +44,17 @@ class YiwuScraper:
         headless_str = os.environ.get("HEADLESS", "true").lower()
         self.headless = headless_str in ("true", "1", "yes")
         
+        # 詳細ページ取得のリトライポリシー（締め切り・バックオフ・ヘッジ・サーキットブレーカー）
+        self.fetch_policy = FetchPolicy.from_env()
+        
+        # メモリ使用量に応じた同時取得数の制御
+        self.memory = MemoryGovernor.from_env()
+        
+        # 実行時間の予算（タイムアウト前に書き込みを始めるため、低優先度の処理を見送る）
+        self.budget = RunBudget.from_env()
+        # 書き込み時間の見積もり関数 estimator(results) -> 秒（設定された場合、一覧取得後に書き込み用の時間を確保する）
+        self.write_estimator = None
+        
         if not self.username or not self.password:
             raise ValueError("YIWU_USERNAME と YIWU_PASSWORD の環境変数を設定してください")
     
@@ -61,6 +85,7 @@ class YiwuScraper:
             logger.error(f"注文状況照会ページ移動エラー: {e}")
             raise
     
+    @profiling.timed
     async def extract_order_data(self, cols):
         """注文データを抽出"""
         status = (await cols[0].text_content() or '').strip()
@@ -122,94 +147,125 @@ class YiwuScraper:
         
         return items
     
-    async def extract_product_links_from_context(self, context, link, max_retries=3):
+    @profiling.timed
+    async def extract_product_links_from_context(self, context, link):
         """
         詳細ページから商品リンクと色・サイズ等指定を抽出（複数商品対応）
+        リンク単位の締め切り・リトライ・ヘッジはfetch_policyに従う
         
         Args:
             context: ブラウザコンテキスト
             link: 詳細ページのURL
-            max_retries: 最大リトライ回数
             
         Returns:
             List[Dict[str, str]]: 商品データのリスト [{"productLink": "...", "colorSize": "..."}, ...]
+                締め切り・リトライ上限・サーキットブレーカーで取得できなかった場合はNone
+                （商品がない場合の空リストと区別し、色・サイズ等指定が空のまま書き込まないため）
         """
-        page = await context.new_page()
+        # プロファイリング時は一部の詳細ページでPlaywrightトレースを取得
+        fetch = self._fetch_product_data_traced if profiling.should_trace() else self._fetch_product_data
+        try:
+            return await self.fetch_policy.execute(lambda: fetch(context, link), link)
+        except Exception as e:
+            logger.warning(f"詳細ページ {link} の処理でエラー: {e!r}")
+            return None
+    
+    async def _fetch_product_data(self, context, link):
+        """
+        詳細ページを1回読み込んで商品データを抽出
+        キャンセルされた場合もページは必ず閉じる
         
-        for attempt in range(max_retries):
-            try:
-                # タイムアウトを60秒に延長
-                await page.goto(link, timeout=60000)
-                await page.wait_for_load_state("networkidle", timeout=60000)
-                
-                # すべての商品セクション（h3見出し「商品1」「商品2」など）を取得
-                product_sections = page.locator('h3:text-matches("商品\\\\d+")')
-                section_count = await product_sections.count()
-                
-                product_data = []
+        Args:
+            context: ブラウザコンテキスト
+            link: 詳細ページのURL
+            
+        Returns:
+            List[Dict[str, str]]: 商品データのリスト
+        """
+        timeout_ms = self.fetch_policy.attempt_timeout * 1000
+        page = await context.new_page()
+        try:
+            await page.goto(link, timeout=timeout_ms)
+            await page.wait_for_load_state("networkidle", timeout=timeout_ms)
+            
+            # すべての商品セクション（h3見出し「商品1」「商品2」など）を取得
+            product_sections = page.locator('h3:text-matches("商品\\\\d+")')
+            section_count = await product_sections.count()
+            
+            product_data = []
+            
+            # 各商品セクションから商品リンクと色・サイズ等指定を抽出
+            for i in range(section_count):
+                # i番目の商品セクションの次にあるテーブルを取得
+                # 「注文情報」セクション内のすべてのテーブルを取得
+                tables = page.locator('table.table.table-bordered.table-striped.table-responsive')
                 
-                # 各商品セクションから商品リンクと色・サイズ等指定を抽出
-                for i in range(section_count):
-                    # i番目の商品セクションの次にあるテーブルを取得
-                    # 「注文情報」セクション内のすべてのテーブルを取得
-                    tables = page.locator('table.table.table-bordered.table-striped.table-responsive')
+                # i番目のテーブルを取得（商品iに対応）
+                if i < await tables.count():
+                    table = tables.nth(i)
                     
-                    # i番目のテーブルを取得（商品iに対応）
-                    if i < await tables.count():
-                        table = tables.nth(i)
-                        
-                        # テーブル内の行を走査
-                        rows = table.locator('tbody > tr')
-                        row_count = await rows.count()
-                        
-                        product_link = ""
-                        color_size = ""
+                    # テーブル内の行を走査
+                    rows = table.locator('tbody > tr')
+                    row_count = await rows.count()
+                    
+                    product_link = ""
+                    color_size = ""
+                    
+                    for row_idx in range(row_count):
+                        row = rows.nth(row_idx)
+                        # tdとthの両方を取得
+                        cells = row.locator('td, th')
+                        cells_count = await cells.count()
                         
-                        for row_idx in range(row_count):
-                            row = rows.nth(row_idx)
-                            # tdとthの両方を取得
-                            cells = row.locator('td, th')
-                            cells_count = await cells.count()
+                        # すべてのセルをループして、thとtdのペアを処理
+                        for cell_idx in range(cells_count - 1):
+                            cell = cells.nth(cell_idx)
+                            next_cell = cells.nth(cell_idx + 1)
                             
-                            # すべてのセルをループして、thとtdのペアを処理
-                            for cell_idx in range(cells_count - 1):
-                                cell = cells.nth(cell_idx)
-                                next_cell = cells.nth(cell_idx + 1)
+                            # 現在のセルがthかどうか確認
+                            tag_name = await cell.evaluate('el => el.tagName')
+                            if tag_name == 'TH':
+                                cell_text = (await cell.text_content() or '').strip()
                                 
-                                # 現在のセルがthかどうか確認
-                                tag_name = await cell.evaluate('el => el.tagName')
-                                if tag_name == 'TH':
-                                    cell_text = (await cell.text_content() or '').strip()
-                                    
-                                    # 色・サイズ等指定を取得
-                                    if cell_text == '色・サイズ等指定':
-                                        color_size = (await next_cell.text_content() or '').strip()
-                                        # 改行を空白に置換して1行にする
-                                        color_size = ' '.join(color_size.split())
-                                    
-                                    # URLを取得
-                                    elif cell_text == 'URL':
-                                        link_locator = next_cell.locator('a')
-                                        if await link_locator.count() > 0:
-                                            product_link = await link_locator.get_attribute('href')
-                        
-                        # 結果に追加
-                        product_data.append({
-                            "productLink": product_link or "",
-                            "colorSize": color_size or ""
-                        })
-                
-                await page.close()
-                return product_data
-                
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    logger.warning(f"詳細ページ {link} の読み込みに失敗。リトライします（{attempt + 1}/{max_retries}）: {e}")
-                    await asyncio.sleep(2)  # 2秒待機してリトライ
-                else:
-                    logger.warning(f"詳細ページ {link} の処理でエラー: {e}")
-                    await page.close()
-                    return []  # リトライ上限に達したら空リストを返す
+                                # 色・サイズ等指定を取得
+                                if cell_text == '色・サイズ等指定':
+                                    color_size = (await next_cell.text_content() or '').strip()
+                                    # 改行を空白に置換して1行にする
+                                    color_size = ' '.join(color_size.split())
+                                
+                                # URLを取得
+                                elif cell_text == 'URL':
+                                    link_locator = next_cell.locator('a')
+                                    if await link_locator.count() > 0:
+                                        product_link = await link_locator.get_attribute('href')
+                    
+                    # 結果に追加
+                    product_data.append({
+                        "productLink": product_link or "",
+                        "colorSize": color_size or ""
+                    })
+            
+            return product_data
+        finally:
+            await page.close()
+    
+    async def _fetch_product_data_traced(self, context, link):
+        """
+        Playwrightトレースを取得しながら詳細ページを読み込む
+        他のページのトレースが混ざらないよう、ログイン状態を引き継いだ専用コンテキストを使用する
+        """
+        traced_context = await context.browser.new_context(storage_state=await context.storage_state())
+        try:
+            await traced_context.tracing.start(screenshots=True, snapshots=True)
+            try:
+                return await self._fetch_product_data(traced_context, link)
+            finally:
+                slug = link.rstrip("/").rsplit("/", 1)[-1] or "detail"
+                trace_path = profiling.artifact_path(f"trace-{slug}-{int(asyncio.get_running_loop().time() * 1000)}.zip")
+                await traced_context.tracing.stop(path=trace_path)
+                logger.info(f"Playwrightトレースを出力しました: {trace_path}")
+        finally:
+            await traced_context.close()
     
     async def has_next_page(self, page, next_link):
         """次ページの存在確認"""
@@ -244,13 +300,52 @@ class YiwuScraper:
         
         return page_results
     
-    async def scrape_all_pages(self, page):
-        """全ページをスクレイピング"""
+    async def open_order_history(self, context):
+        """
+        注文状況照会ページを新しいタブで直接開く（セッション切れの場合は再ログイン）
+        
+        Args:
+            context: ログイン済みのブラウザコンテキスト
+            
+        Returns:
+            注文状況照会ページを開いたページ
+        """
+        page = await context.new_page()
+        try:
+            await page.goto(self.inquiry_url)
+            await page.wait_for_load_state("networkidle")
+            if page.url.startswith(self.login_url):
+                logger.info("セッションが切れているため再ログインします")
+                await self.login(page)
+                await page.goto(self.inquiry_url)
+                await page.wait_for_load_state("networkidle")
+            return page
+        except Exception:
+            await page.close()
+            raise
+    
+    async def scrape_all_pages(self, page, max_pages=None, stop_when=None):
+        """
+        全ページをスクレイピング
+        
+        Args:
+            page: 注文状況照会ページを開いたページ
+            max_pages: 取得する最大ページ数（Noneの場合は全ページ）
+            stop_when: ページ単位の結果を受け取り、Trueを返したら以降のページを取得しない関数
+        """
         results = []
+        page_count = 0
         
         while True:
+            started = time.monotonic()
             page_results = await self.scrape_page_data(page)
             results.extend(page_results)
+            page_count += 1
+            
+            if stop_when and stop_when(page_results):
+                break
+            if max_pages and page_count >= max_pages:
+                break
             
             next_link = page.locator('ul.pagination a[rel="next"]')
             if not await self.has_next_page(page, next_link):
@@ -261,60 +356,127 @@ class YiwuScraper:
             if not next_href or next_href.strip() == '#' or next_href.strip().lower().startswith('javascript'):
                 break
             
+            # 一覧は新しい順のため、時間が足りない場合は古いページを次回に回す
+            if not self.budget.can_start(self.budget.average("一覧ページ", 0)):
+                logger.warning(f"実行時間の予算が残り少ないため、{page_count + 1}ページ目以降の取得を見送ります")
+                self.budget.defer("一覧ページ", [f"{page_count + 1}ページ目以降"])
+                break
+            
             next_url = urljoin(page.url, next_href)
             await page.goto(next_url)
             await page.wait_for_load_state("networkidle")
+            self.budget.record("一覧ページ", time.monotonic() - started)
         
         return results
     
-    async def enrich_with_product_links(self, context, results, batch_size=10):
+    async def enrich_with_product_links(self, context, results, recycle_context=False):
         """
         商品リンクと色・サイズ等指定でデータを拡張（複数商品対応）
+        同時取得数はメモリ使用量に応じてMemoryGovernorが調整する
         
         Args:
             context: ブラウザコンテキスト
             results: スクレイピング結果のリスト
-            batch_size: 並列処理のバッチサイズ
+            recycle_context: メモリが危険域に達したときにコンテキストを作り直すかどうか
+                （呼び出し元が渡したコンテキストも閉じられるため、コンテキストを専有する場合のみTrue）
         """
-        # 詳細リンクのリストを作成（重複を除外）
+        # 詳細リンクのリストを優先度順（進行中 → 完了済み、それぞれ新しい順）に作成（重複を除外）
         detail_links = []
         seen_links = set()
-        for r in results:
+        for r in DataProcessor.prioritize(results):
             detail_link = r.get("detailLink", "")
             if detail_link and detail_link not in seen_links:
                 detail_links.append(detail_link)
                 seen_links.add(detail_link)
         
-        logger.info(f"{len(detail_links)}件の詳細ページから商品リンクと色・サイズ等指定を取得します")
+        logger.info(f"{len(detail_links)}件の詳細ページから商品リンクと色・サイズ等指定を取得します"
+                    f"（最大同時取得数: {self.memory.max_concurrency}）")
         
-        # バッチ処理で並列実行
-        product_links = {}  # {detail_link: [{"productLink": "...", "colorSize": "..."}, ...]}
-        for i in range(0, len(detail_links), batch_size):
-            batch = detail_links[i:i + batch_size]
-            logger.info(f"バッチ {i // batch_size + 1}/{(len(detail_links) + batch_size - 1) // batch_size} を処理中...")
-            
-            # バッチ内のタスクを並列実行
-            tasks = [self.extract_product_links_from_context(context, link) for link in batch]
-            results_list = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # 結果を辞書に格納
-            for j, detail_link in enumerate(batch):
-                product_data = results_list[j]
+        # 観測済みの取得時間から書き込み開始までに取得できる件数を見積もり、超える分は優先度の低い注文から見送る
+        targets = detail_links
+        affordable = self.budget.affordable("詳細ページ", default=DEFAULT_DETAIL_SECONDS,
+                                            concurrency=self.memory.concurrency)
+        if affordable is not None and affordable < len(detail_links):
+            estimated = self.budget.estimate("詳細ページ", len(detail_links), default=DEFAULT_DETAIL_SECONDS,
+                                             concurrency=self.memory.concurrency)
+            logger.warning(f"詳細ページの取得見積もり{estimated:.0f}秒が書き込み開始までの残り時間"
+                           f"{self.budget.time_before_flush():.0f}秒を超えています。"
+                           f"優先度の低い{len(detail_links) - affordable}件の注文を見送ります")
+            targets = detail_links[:affordable]
+        
+        # 取得中に作り直される可能性があるため、現在のコンテキストを保持する
+        current = {"context": context}
+        
+        async def fetch(link):
+            started = time.monotonic()
+            try:
+                return await self.extract_product_links_from_context(current["context"], link)
+            finally:
+                self.budget.record("詳細ページ", time.monotonic() - started)
+        
+        def should_stop():
+            # 最悪ケース（リンク単位の締め切り）でも書き込み開始までに終わらない場合は新規取得を止める
+            return not self.budget.can_start(self.fetch_policy.link_deadline)
+        
+        async def recycle():
+            old_context = current["context"]
+            logger.info("ブラウザコンテキストを作り直します（ログイン状態は引き継ぎ）")
+            storage_state = await old_context.storage_state()
+            current["context"] = await old_context.browser.new_context(storage_state=storage_state)
+            await old_context.close()
+        
+        # メモリ使用量に応じた同時実行数で取得
+        # コンテキストを作り直せない場合は、危険域でも実行中のページの完了を待たずに取得を続ける（同時取得数の調整のみ）
+        fetched = await self.memory.run(targets, fetch, on_critical=recycle if recycle_context else None,
+                                        should_stop=should_stop)
+        
+        # 取得を見送ったリンクの注文は書き込み対象から外し、次回の実行に回す
+        deferred_links = {link for link in detail_links if link not in fetched}
+        if deferred_links:
+            deferred_orders = []
+            for r in results:
+                if r.get("detailLink", "") in deferred_links:
+                    r["deferred"] = True
+                    if r.get("orderId") not in deferred_orders:
+                        deferred_orders.append(r.get("orderId"))
+            logger.warning(f"実行時間の予算が残り少ないため、{len(deferred_links)}件の詳細ページの取得を見送りました")
+            self.budget.defer("詳細ページ", deferred_orders)
+        
+        # 取得に失敗したリンクの注文も、色・サイズ等指定が空のまま書き込むと重複行になるため次回に回す
+        failed_links = set()
+        for detail_link in detail_links:
+            if detail_link in deferred_links:
+                continue
+            product_data = fetched.get(detail_link)
+            if product_data is None or isinstance(product_data, Exception):
                 if isinstance(product_data, Exception):
                     logger.warning(f"詳細ページ {detail_link} の処理でエラー: {product_data}")
-                    product_links[detail_link] = []
-                else:
-                    product_links[detail_link] = product_data if product_data else []
-            
-            # バッチ間で待機（サーバー負荷を考慮）
-            if i + batch_size < len(detail_links):
-                await asyncio.sleep(1)
+                failed_links.add(detail_link)
+        if failed_links:
+            failed_orders = []
+            for r in results:
+                if r.get("detailLink", "") in failed_links:
+                    r["deferred"] = True
+                    if r.get("orderId") not in failed_orders:
+                        failed_orders.append(r.get("orderId"))
+            logger.warning(f"{len(failed_links)}件の詳細ページの取得に失敗したため、該当する注文の書き込みを次回に回します")
+            self.budget.defer("詳細ページ（取得失敗）", failed_orders)
+            deferred_links |= failed_links
+        
+        # 結果を辞書に格納
+        product_links = {}  # {detail_link: [{"productLink": "...", "colorSize": "..."}, ...]}
+        for detail_link in detail_links:
+            if detail_link in deferred_links:
+                continue
+            product_links[detail_link] = fetched.get(detail_link) or []
         
         # 結果を各注文に追加（順序で紐付け）
         detail_link_indices = {}  # 各detail_linkの現在のインデックスを追跡
         
         for r in results:
             detail_link = r.get("detailLink", "")
+            if detail_link not in deferred_links:
+                r.pop("deferred", None)
             
             # このdetail_linkで何番目のアイテムか
             if detail_link not in detail_link_indices:
@@ -334,105 +496,273 @@ class YiwuScraper:
             
             detail_link_indices[detail_link] += 1
     
+    @asynccontextmanager
+    async def browser_session(self):
+        """
+        ログイン済みのブラウザセッションを開く
+        
+        Yields:
+            Tuple: (ブラウザコンテキスト, ログイン済みのページ)
+        """
+        # Playwrightはブラウザを使うステージでのみ読み込む（write単体実行では不要）
+        from playwright.async_api import async_playwright
+        
+        async with async_playwright() as p:
+            # Headlessモードを環境変数で制御（デフォルトはTrue）
+            browser = await p.chromium.launch(headless=self.headless)
+            try:
+                with self.memory.phase("login"):
+                    context = await browser.new_context()
+                    page = await context.new_page()
+                    await self.login(page)
+                yield context, page
+            finally:
+                await browser.close()
+    
+    async def scrape(self):
+        """注文一覧の全ページをスクレイピング（詳細ページは取得しない）"""
+        try:
+            logger.info(f"スクレイピング開始... (Headless: {self.headless})")
+            async with self.browser_session() as (context, page):
+                with self.memory.phase("scrape"):
+                    await self.navigate_to_order_history(page)
+                    results = await self.scrape_all_pages(page)
+            logger.info(f"スクレイピング完了: {len(results)}件のデータを取得")
+            return results
+        except Exception as e:
+            logger.error(f"スクレイピングエラー: {e}")
+            raise
+    
+    async def enrich(self, results):
+        """スクレイピング結果を詳細ページの商品リンクと色・サイズ等指定で拡張"""
+        try:
+            logger.info(f"詳細ページの取得開始... (Headless: {self.headless})")
+            async with self.browser_session() as (context, page):
+                with self.memory.phase("enrich"):
+                    await self.enrich_with_product_links(context, results, recycle_context=True)
+            logger.info(f"詳細ページの取得完了: {len(results)}件のデータを拡張")
+            return results
+        except Exception as e:
+            logger.error(f"詳細ページ取得エラー: {e}")
+            raise
+    
     async def run(self):
         """メイン実行メソッド"""
         try:
             logger.info(f"スクレイピング開始... (Headless: {self.headless})")
-            async with async_playwright() as p:
-                # Headlessモードを環境変数で制御（デフォルトはTrue）
-                browser = await p.chromium.launch(headless=self.headless)
-                context = await browser.new_context()
-                page = await context.new_page()
-                
-                # ログインとページ移動
-                await self.login(page)
-                await self.navigate_to_order_history(page)
-                
+            async with self.browser_session() as (context, page):
                 # 全ページをスクレイピング
-                results = await self.scrape_all_pages(page)
+                with self.memory.phase("scrape"):
+                    await self.navigate_to_order_history(page)
+                    results = await self.scrape_all_pages(page)
                 
-                # 商品リンクでデータを拡張
-                await self.enrich_with_product_links(context, results)
+                # 書き込み対象の件数がわかった時点で、書き込みにかかる時間を確保する
+                if self.write_estimator is not None:
+                    self.budget.reserve_for_writes(self.write_estimator(results))
                 
-                await browser.close()
-                logger.info(f"スクレイピング完了: {len(results)}件のデータを取得")
-                return results
+                # 商品リンクでデータを拡張
+                with self.memory.phase("enrich"):
+                    await self.enrich_with_product_links(context, results, recycle_context=True)
+            
+            logger.info(f"スクレイピング完了: {len(results)}件のデータを取得")
+            return results
                 
         except Exception as e:
             logger.error(f"スクレイピングエラー: {e}")
             raise
 
 
-class DataProcessor:
-    """データ処理クラス"""
+# ステージ間の受け渡しファイルのデフォルト配置先
+DEFAULT_ORDERS_PATH = data_path("orders.jsonl")
+DEFAULT_ENRICHED_PATH = data_path("enriched.jsonl")
+
+
+async def run_concurrently(scrape, prepare):
+    """
+    スクレイピングと出力先の準備を並行して実行
+    どちらかが失敗した時点でもう一方をキャンセルし、エラーを早期に通知する
     
-    @staticmethod
-    def prepare_google_sheets_data(results):
-        """Google Sheets用のデータを準備"""
-        from datetime import datetime
-        
-        headers = [
-            "ステータス",
-            "注文番号",
-            "注文日",
-            "見積完了日",
-            "買付完了日",
-            "中国事務所到着日",
-            "発送可能日",
-            "注文詳細リンク",
-            "商品リンク",
-            "商品画像",
-            "商品名",
-            "色・サイズ等指定",
-            "更新日",
-        ]
-        
-        # 現在の日時を取得
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        values = [headers]
-        for r in results:
-            values.append([
-                r.get("status", ""),
-                r.get("orderId", ""),
-                r.get("orderedAt", ""),
-                r.get("estimatedAt", ""),
-                r.get("purchasedAt", ""),
-                r.get("arrivedChinaAt", ""),
-                r.get("shippableAt", ""),
-                r.get("detailLink", ""),
-                r.get("orderLink", ""),
-                r.get("imageUrl", ""),
-                r.get("itemName", ""),
-                r.get("colorSize", ""),  # 色・サイズ等指定
-                current_time,  # 更新日
-            ])
-        return values
+    Args:
+        scrape: スクレイピングのコルーチン
+        prepare: 出力先の準備のコルーチン
+        
+    Returns:
+        スクレイピング結果
+    """
+    scrape_task = asyncio.ensure_future(scrape)
+    prepare_task = asyncio.ensure_future(prepare)
+    tasks = {scrape_task, prepare_task}
+    
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+        await prepare_task
+        return await scrape_task
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
-async def main():
-    """メイン実行関数"""
+async def main(sinks_spec=None):
+    """メイン実行関数（scrape → enrich → write を一括実行）"""
+    scraper = None
     try:
         logger.info("=== イーウーパスポート スクレイピング開始 ===")
         
-        # スクレイピング実行
+        # 出力先の指定ミスはスクレイピング前に検出する
+        output_sinks = sinks.build_sinks(sinks_spec)
         scraper = YiwuScraper()
-        results = await scraper.run()
+        scraper.write_estimator = lambda results: sinks.estimate_write_seconds(output_sinks, results)
         
-        # データ処理
-        processor = DataProcessor()
-        values = processor.prepare_google_sheets_data(results)
+        # ブラウザ起動・ログイン・スクレイピングと、出力先の認証・既存データの取得を並行して実行
+        results = await run_concurrently(scraper.run(), sinks.prepare_sinks(output_sinks))
         
-        # Google Sheetsに書き込み
-        logger.info("Google Sheetsに書き込み中...")
-        google_sheet.GSheet().write(values)
+        # 出力先に並行して書き込み（優先度順、タイムアウト前に打ち切り）
+        with scraper.memory.phase("write"):
+            await write_results(output_sinks, results, scraper.budget)
         
         logger.info("=== スクレイピング完了 ===")
         
     except Exception as e:
         logger.error(f"=== エラーが発生しました: {e} ===")
         raise
+    
+    finally:
+        if scraper is not None:
+            scraper.budget.log_summary()
+
+
+async def write_results(output_sinks, results, budget):
+    """
+    見送った注文を除き、優先度順に出力先へ書き込み
+    
+    Args:
+        output_sinks: シンクのリスト
+        results: スクレイピング結果
+        budget: 実行時間の予算
+    """
+    ready, deferred = DataProcessor.split_deferred(results)
+    if deferred:
+        logger.warning(f"詳細ページ未取得の{len(deferred)}件は書き込みを見送ります")
+    await sinks.write_to_sinks(output_sinks, DataProcessor.prioritize(ready), deadline=budget.write_deadline())
+
+
+async def scrape_stage(output_path):
+    """scrapeステージ: 注文一覧をスクレイピングしてファイルに保存"""
+    logger.info("=== scrapeステージ開始 ===")
+    scraper = YiwuScraper()
+    # このステージは出力先に書き込まないため、書き込み用の時間を確保しない
+    scraper.budget = RunBudget.from_env(writes=False)
+    results = await scraper.scrape()
+    interchange.write_records(output_path, results)
+    logger.info("=== scrapeステージ完了 ===")
+
+
+async def enrich_stage(input_path, output_path):
+    """enrichステージ: 保存済みの注文データを詳細ページの情報で拡張"""
+    logger.info("=== enrichステージ開始 ===")
+    results = list(interchange.read_records(input_path))
+    scraper = YiwuScraper()
+    # このステージは出力先に書き込まないため、書き込み用の時間を確保しない
+    scraper.budget = RunBudget.from_env(writes=False)
+    await scraper.enrich(results)
+    interchange.write_records(output_path, results)
+    scraper.budget.log_summary()
+    logger.info("=== enrichステージ完了 ===")
+
+
+async def write_stage(input_path, sinks_spec=None):
+    """writeステージ: 保存済みのデータを出力先に書き込み"""
+    logger.info("=== writeステージ開始 ===")
+    budget = RunBudget.from_env()
+    output_sinks = sinks.build_sinks(sinks_spec)
+    results = list(interchange.read_records(input_path))
+    await write_results(output_sinks, results, budget)
+    budget.log_summary()
+    logger.info("=== writeステージ完了 ===")
+
+
+async def analyze_stage(input_path):
+    """analyzeステージ: 保存済みのデータからリードタイムを集計してサマリーシートに書き込み"""
+    logger.info("=== analyzeステージ開始 ===")
+    results = list(interchange.read_records(input_path))
+    await sinks.write_to_sinks([sinks.SummarySink(required=True)], results)
+    logger.info("=== analyzeステージ完了 ===")
+
+
+def changes_stage(since=None, after_id=None, event_type=None, order_id=None, output_path="-"):
+    """changesコマンド: 変更履歴から条件に合うイベントを出力"""
+    change_log = ChangeLog.from_env()
+    if change_log is None:
+        raise RuntimeError("変更履歴が無効です（YIWU_CHANGE_LOG を設定してください）")
+    events = change_log.since(ts=since, after_id=after_id, event_type=event_type, order_id=order_id)
+    interchange.write_records(output_path, events)
+
+
+def parse_args(argv=None):
+    """コマンドライン引数を解析"""
+    parser = argparse.ArgumentParser(description="イーウーパスポート スクレイピング")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    sinks_help = "出力先（カンマ区切り: sheets / summary / sqlite[:パス] / csv[:パス] / parquet[:パス]、デフォルト: 環境変数 YIWU_SINKS）"
+    parser.add_argument("--sinks", help=sinks_help)
+    
+    run_parser = subparsers.add_parser("run", help="scrape → enrich → write を一括実行（デフォルト）")
+    run_parser.add_argument("--sinks", help=sinks_help, default=argparse.SUPPRESS)
+    
+    scrape_parser = subparsers.add_parser("scrape", help="注文一覧をスクレイピングしてファイルに保存")
+    scrape_parser.add_argument("-o", "--output", default=DEFAULT_ORDERS_PATH,
+                               help=f"出力ファイル（デフォルト: {DEFAULT_ORDERS_PATH}、- で標準出力）")
+    
+    enrich_parser = subparsers.add_parser("enrich", help="詳細ページの商品リンクと色・サイズ等指定を付与")
+    enrich_parser.add_argument("-i", "--input", default=DEFAULT_ORDERS_PATH,
+                               help=f"入力ファイル（デフォルト: {DEFAULT_ORDERS_PATH}、- で標準入力）")
+    enrich_parser.add_argument("-o", "--output", default=DEFAULT_ENRICHED_PATH,
+                               help=f"出力ファイル（デフォルト: {DEFAULT_ENRICHED_PATH}、- で標準出力）")
+    
+    write_parser = subparsers.add_parser("write", help="保存済みのデータを出力先に書き込み")
+    write_parser.add_argument("-i", "--input", default=DEFAULT_ENRICHED_PATH,
+                              help=f"入力ファイル（デフォルト: {DEFAULT_ENRICHED_PATH}、- で標準入力）")
+    write_parser.add_argument("--sinks", help=sinks_help, default=argparse.SUPPRESS)
+    
+    analyze_parser = subparsers.add_parser("analyze", help="保存済みのデータからリードタイムを集計してサマリーシートに書き込み")
+    analyze_parser.add_argument("-i", "--input", default=DEFAULT_ENRICHED_PATH,
+                                help=f"入力ファイル（デフォルト: {DEFAULT_ENRICHED_PATH}、- で標準入力）")
+    
+    changes_parser = subparsers.add_parser("changes", help="変更履歴（注文の状態遷移イベント）を出力")
+    changes_parser.add_argument("--since", help="この時刻（ISO形式、例: 2024-01-01T00:00:00）以降のイベント")
+    changes_parser.add_argument("--after-id", type=int, help="このイベントIDより後のイベント")
+    changes_parser.add_argument("--type", dest="event_type",
+                                help="イベント種別（new_item / status_change / date_filled / field_change / archived）")
+    changes_parser.add_argument("--order-id", help="注文番号")
+    changes_parser.add_argument("-o", "--output", default="-", help="出力ファイル（デフォルト: - で標準出力）")
+    
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    """コマンドラインエントリーポイント"""
+    args = parse_args(argv)
+    
+    # YIWU_PROFILE=true の場合はコマンド全体をプロファイリング
+    with profiling.session(args.command or "run"):
+        if args.command == "scrape":
+            asyncio.run(scrape_stage(args.output))
+        elif args.command == "enrich":
+            asyncio.run(enrich_stage(args.input, args.output))
+        elif args.command == "write":
+            asyncio.run(write_stage(args.input, args.sinks))
+        elif args.command == "analyze":
+            asyncio.run(analyze_stage(args.input))
+        elif args.command == "changes":
+            changes_stage(args.since, args.after_id, args.event_type, args.order_id, args.output)
+        else:
+            asyncio.run(main(args.sinks))
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    cli()